@@ -0,0 +1,252 @@
+'''
+The benchmarks of the splitter, the collectors, the sorter and the
+word count job, e.g.
+
+    python benchmarks/bench.py --scale 2 --only word_count
+
+Each benchmark runs in a new process, which reports the throughput and
+the peak RSS of itself and its children. The results are stored into
+benchmarks/results/<label>.json, the label is the git revision by
+default, and compared with a baseline, which is the last stored results
+of the same scale by default, so that the regressions show up.
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+
+BENCHMARK_PATH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_PATH))
+
+from core.job import Job, Configure
+from core.splitter import LineSplitter
+from core.collector import FileCollector, SortFileCollector
+from core.sorter import HeapSorter
+from core.mapper import BaseMapper
+from core.reducer import BaseReducer
+from generators import UniformWords, ZipfWords, write_words, write_wide_values, kv_pairs
+
+RESULTS_PATH = os.path.join(BENCHMARK_PATH, 'results')
+REGRESSION_THRESHOLD = 0.1
+
+class WordCountMapper(BaseMapper):
+    def map(self, key, value, collector):
+        for word in value.split():
+            collector.collect(word, 1)
+
+class WordCountReducer(BaseReducer):
+    def reduce(self, key, values, collector):
+        collector.collect(key, sum(values))
+
+def bench_line_splitter(data_dir, data_size, partitions=8):
+    output_dir = tempfile.mkdtemp()
+    try:
+        outputers = [open(os.path.join(output_dir, 'split_%d' % i), 'wb') for i in range(partitions)]
+        start = time.time()
+        splitter = LineSplitter(data_dir, outputers, partitions)
+        splitter.split()
+        for outputer in outputers:
+            outputer.close()
+        seconds = time.time() - start
+    finally:
+        shutil.rmtree(output_dir)
+    return {'seconds': seconds, 'bytes': data_size}
+
+def bench_collector(collector_class, words, records, slice_num=8):
+    output_dir = tempfile.mkdtemp()
+    try:
+        kvs = list(kv_pairs(words, records))
+        start = time.time()
+        collector = collector_class({'path': output_dir, 'prefix': 'bench', 'slice_num': slice_num})
+        for key, value in kvs:
+            collector.collect(key, value)
+        collector.close()
+        seconds = time.time() - start
+    finally:
+        shutil.rmtree(output_dir)
+    return {'seconds': seconds, 'records': records}
+
+def bench_heap_sorter(words, records, slice_num=8):
+    kvs = list(kv_pairs(words, records))
+    start = time.time()
+    sorter = HeapSorter(slice_num)
+    for idx, (key, value) in enumerate(kvs):
+        sorter.add(idx % slice_num, key, value)
+    for idx in range(slice_num):
+        for kv in sorter.get_all_results(idx):
+            pass
+    return {'seconds': time.time() - start, 'records': records}
+
+def bench_word_count(data_dir, data_size, workers):
+    output_dir = tempfile.mkdtemp()
+    try:
+        conf_file = os.path.join(output_dir, 'mapred.conf')
+        with open(conf_file, 'w') as conf:
+            conf.write('{}')
+        job = Job(Configure(conf_file))
+        job.set_mapper(WordCountMapper)
+        job.set_reducer_class(WordCountReducer)
+        job.set_combiner_class(WordCountReducer)
+        job.set_mapper_num(workers)
+        job.set_reducer_num(workers)
+        job.add_input_dir(data_dir)
+        job.set_output_path(os.path.join(output_dir, 'output'))
+        start = time.time()
+        if not job.run():
+            raise RuntimeError('the word count job failed')
+        seconds = time.time() - start
+    finally:
+        shutil.rmtree(output_dir)
+    return {'seconds': seconds, 'bytes': data_size}
+
+def _run_benchmark(queue, func, args):
+    result = func(*args)
+    # the peak RSS of the benchmark process and of its biggest child, in KB on linux
+    result['peak_rss_kb'] = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    queue.put(result)
+
+def run_benchmark(name, func, args):
+    '''
+    Runs a benchmark in a new process, so that its peak RSS is not
+    affected by the other benchmarks.
+    '''
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_benchmark, args=(queue, func, args))
+    process.start()
+    result = queue.get()
+    process.join()
+    if 'records' in result:
+        result['records_per_second'] = result['records'] / result['seconds']
+    if 'bytes' in result:
+        result['mb_per_second'] = result['bytes'] / result['seconds'] / (1 << 20)
+    return result
+
+def throughput(result):
+    return result.get('records_per_second', result.get('mb_per_second'))
+
+def generate_data(data_path, scale):
+    '''
+    Generates the inputs of the benchmarks, and returns a dict of the
+    dir and size of each data set.
+    '''
+    datasets = {}
+    lines = 25000 * scale
+    datasets['uniform'] = (os.path.join(data_path, 'uniform'),
+            write_words(os.path.join(data_path, 'uniform'), UniformWords(100000), 4, lines, 10))
+    datasets['zipf'] = (os.path.join(data_path, 'zipf'),
+            write_words(os.path.join(data_path, 'zipf'), ZipfWords(100000), 4, lines, 10))
+    datasets['wide'] = (os.path.join(data_path, 'wide'),
+            write_wide_values(os.path.join(data_path, 'wide'), 4, 500 * scale, 4096))
+    return datasets
+
+def benchmarks(datasets, scale, workers_list):
+    records = 200000 * scale
+    yield 'line_splitter.uniform', bench_line_splitter, datasets['uniform']
+    yield 'line_splitter.wide', bench_line_splitter, datasets['wide']
+    yield 'file_collector.uniform', bench_collector, (FileCollector, UniformWords(100000), records)
+    yield 'sort_file_collector.uniform', bench_collector, (SortFileCollector, UniformWords(100000), records)
+    yield 'sort_file_collector.zipf', bench_collector, (SortFileCollector, ZipfWords(100000), records)
+    yield 'heap_sorter.uniform', bench_heap_sorter, (UniformWords(100000), records)
+    for workers in workers_list:
+        for dataset in ('uniform', 'zipf'):
+            yield 'word_count.%s.workers_%d' % (dataset, workers), bench_word_count, datasets[dataset] + (workers,)
+
+def default_label():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                    cwd=BENCHMARK_PATH, stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return time.strftime('%Y%m%d_%H%M%S')
+
+def load_baseline(results_path, scale, label):
+    '''
+    Returns the last stored results of the same scale except the label.
+    '''
+    if not os.path.isdir(results_path):
+        return None
+    candidates = []
+    for name in os.listdir(results_path):
+        with open(os.path.join(results_path, name)) as results_file:
+            results = json.load(results_file)
+        if results['scale'] == scale and results['label'] != label:
+            candidates.append((results['time'], results))
+    return max(candidates)[1] if candidates else None
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    '''
+    Prints the change of the throughput of each benchmark against the
+    baseline, and returns the names of the regressed benchmarks.
+    '''
+    regressions = []
+    names = sorted(name for name in results['results'] if name in baseline['results'])
+    if names:
+        print 'compared with %s:' % baseline['label']
+    for name in names:
+        result = results['results'][name]
+        change = throughput(result) / throughput(baseline['results'][name]) - 1
+        regressed = change < -threshold
+        if regressed:
+            regressions.append(name)
+        print '%-40s %+7.1f%%%s' % (name, change * 100, '  REGRESSION' if regressed else '')
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of mapred')
+    parser.add_argument('--scale', type=int, default=1, help='the multiple of the data sizes')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 16],
+            help='the numbers of workers of the word count job')
+    parser.add_argument('--only', help='only run the benchmarks whose names contain it')
+    parser.add_argument('--label', help='the label of the results, the git revision by default')
+    parser.add_argument('--results', default=RESULTS_PATH, help='the dir of the stored results')
+    parser.add_argument('--baseline', help='the results to compare with, the last results by default')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    label = args.label or default_label()
+    results = {'label': label,
+               'time': time.time(),
+               'scale': args.scale,
+               'python': platform.python_version(),
+               'machine': platform.machine(),
+               'cpus': multiprocessing.cpu_count(),
+               'results': {}}
+
+    data_path = tempfile.mkdtemp()
+    try:
+        datasets = generate_data(data_path, args.scale)
+        for name, func, func_args in benchmarks(datasets, args.scale, args.workers):
+            if args.only and args.only not in name:
+                continue
+            result = run_benchmark(name, func, func_args)
+            results['results'][name] = result
+            print '%-40s %10.1f %s/s %8d KB peak RSS' % (name, throughput(result),
+                    'records' if 'records' in result else 'MB', result['peak_rss_kb'])
+    finally:
+        shutil.rmtree(data_path)
+
+    if not os.path.exists(args.results):
+        os.makedirs(args.results)
+    baseline = load_baseline(args.results, args.scale, label)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    results_file_path = os.path.join(args.results, '%s.json' % label)
+    with open(results_file_path, 'w') as results_file:
+        json.dump(results, results_file, indent=2, sort_keys=True)
+    print 'the results are stored in %s' % results_file_path
+
+    if baseline is not None and compare(results, baseline):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
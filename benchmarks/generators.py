@@ -0,0 +1,77 @@
+import os
+import random
+import bisect
+
+def _accumulate(weights):
+    total = 0.0
+    cumulative = []
+    for weight in weights:
+        total += weight
+        cumulative.append(total)
+    return cumulative
+
+class UniformWords(object):
+    '''
+    Draws the words of a vocabulary uniformly.
+    '''
+    def __init__(self, vocabulary_size, seed=0):
+        self.vocabulary_size = vocabulary_size
+        self.random = random.Random(seed)
+
+    def word(self):
+        return 'w%d' % self.random.randint(0, self.vocabulary_size - 1)
+
+class ZipfWords(object):
+    '''
+    Draws the words of a vocabulary by a Zipf distribution, so that a
+    few words are very frequent like the words of a natural language.
+    '''
+    def __init__(self, vocabulary_size, s=1.1, seed=0):
+        self.cumulative = _accumulate([1.0 / rank ** s for rank in xrange(1, vocabulary_size + 1)])
+        self.random = random.Random(seed)
+
+    def word(self):
+        rank = bisect.bisect_left(self.cumulative, self.random.random() * self.cumulative[-1])
+        return 'w%d' % min(rank, len(self.cumulative) - 1)
+
+def write_words(path, words, files, lines, words_per_line):
+    '''
+    Writes the files of lines of words drawn by words into the dir path,
+    and returns the number of bytes written.
+    '''
+    if not os.path.exists(path):
+        os.makedirs(path)
+    size = 0
+    for idx in range(files):
+        with open(os.path.join(path, 'input_%d' % idx), 'w') as output:
+            for i in xrange(lines):
+                line = '%s\n' % ' '.join(words.word() for j in xrange(words_per_line))
+                output.write(line)
+                size += len(line)
+    return size
+
+def write_wide_values(path, files, lines, value_size, seed=0):
+    '''
+    Writes the files of lines of a key and a wide value of value_size
+    bytes into the dir path, and returns the number of bytes written.
+    '''
+    if not os.path.exists(path):
+        os.makedirs(path)
+    rand = random.Random(seed)
+    size = 0
+    for idx in range(files):
+        with open(os.path.join(path, 'input_%d' % idx), 'w') as output:
+            for i in xrange(lines):
+                value = ''.join(chr(rand.randint(97, 122)) for j in xrange(64))
+                line = 'k%d %s\n' % (rand.randint(0, 999), (value * (value_size / 64 + 1))[:value_size])
+                output.write(line)
+                size += len(line)
+    return size
+
+def kv_pairs(words, num, value_size=8):
+    '''
+    Yields num k/v pairs whose keys are drawn by words.
+    '''
+    value = 'v' * value_size
+    for i in xrange(num):
+        yield words.word(), value
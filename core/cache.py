@@ -0,0 +1,220 @@
+import os
+import json
+import errno
+import shutil
+import hashlib
+import inspect
+import logging
+import tempfile
+
+# changed whenever the format of the map outputs changes
+CACHE_VERSION = 2
+
+COUNTERS_NAME = 'counters.json'
+
+_source_hashes = {}
+
+def _source_hash(cls):
+    '''
+    Returns the sha1 of the source file of a class, so that any change
+    of the module, e.g. of a helper function of a mapper, changes it.
+    '''
+    try:
+        path = inspect.getsourcefile(cls)
+    except TypeError:
+        path = None
+    if path is None:
+        return ''
+    if path not in _source_hashes:
+        try:
+            with open(path, 'rb') as source:
+                _source_hashes[path] = hashlib.sha1(source.read()).hexdigest()
+        except IOError:
+            _source_hashes[path] = ''
+    return _source_hashes[path]
+
+def _stable_repr(obj):
+    '''
+    Returns a repr of obj which does not depend on the order of the
+    dicts and sets, the classes are represented by their names and
+    the hashes of their source files, and the other objects by their
+    classes and attributes.
+    '''
+    if obj is None or isinstance(obj, (bool, int, long, float, basestring)):
+        return repr(obj)
+    if isinstance(obj, (list, tuple)):
+        return '[%s]' % ', '.join(_stable_repr(item) for item in obj)
+    if isinstance(obj, dict):
+        return '{%s}' % ', '.join(sorted('%s: %s' % (_stable_repr(k), _stable_repr(v)) for k, v in obj.iteritems()))
+    if isinstance(obj, (set, frozenset)):
+        return 'set(%s)' % ', '.join(sorted(_stable_repr(item) for item in obj))
+    if isinstance(obj, type):
+        return '%s.%s:%s' % (obj.__module__, obj.__name__, _source_hash(obj))
+    if hasattr(obj, '__dict__'):
+        return '%s(%s)' % (_stable_repr(type(obj)), _stable_repr(vars(obj)))
+    return repr(obj)
+
+def fingerprint(*parts):
+    '''
+    Returns the sha1 hex digest of the parts, e.g. of the classes and
+    the options which decide the outputs of a map task.
+    '''
+    return hashlib.sha1(_stable_repr((CACHE_VERSION,) + parts)).hexdigest()
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.copy2(src, dst)
+
+def _slice_files(path, prefix):
+    '''
+    Returns the (slice, name) of the output files of a collector of the
+    prefix in the dir path, i.e. the files named prefix_<slice>.
+    '''
+    slice_files = []
+    for name in os.listdir(path):
+        head, sep, tail = name.rpartition('_')
+        if head == prefix and tail.isdigit():
+            slice_files.append((int(tail), name))
+    return slice_files
+
+class MapOutputCache(object):
+    '''
+    The MapOutputCache keeps the partitioned outputs of the map tasks on
+    the local disk by a content address, which is the fingerprint of the
+    split, of the code of the mapper and of the options partitioning the
+    outputs, so that a job re-run over mostly unchanged inputs maps only
+    the new or changed splits.
+
+    Each entry is a dir named by its key holding one file per slice, and
+    the counters of the task which mapped them, so that a cache hit
+    reports the same counters as the mapping, e.g. its input records. An
+    entry is written into a hidden temporary dir and renamed, so a
+    partial entry is never seen. The mtime of an entry is updated
+    whenever it is used, and the least recently used entries are removed
+    by evict() until the cache holds at most max_bytes.
+    '''
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+
+    def key(self, *parts):
+        return fingerprint(*parts)
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key)
+
+    def get(self, key, output_dir, prefix):
+        '''
+        Links the cached outputs of the key into output_dir as the files
+        of the prefix, and returns the counters cached with them, or None
+        if the key is not cached.
+        '''
+        entry_path = self._entry_path(key)
+        if not os.path.isdir(entry_path):
+            return None
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        try:
+            with open(os.path.join(entry_path, COUNTERS_NAME)) as counters_file:
+                counters = json.load(counters_file)
+            for name in os.listdir(entry_path):
+                if name.isdigit():
+                    _link_or_copy(os.path.join(entry_path, name), os.path.join(output_dir, '%s_%s' % (prefix, name)))
+            os.utime(entry_path, None)
+        except (IOError, OSError):
+            # the entry was evicted meanwhile
+            logging.info('failed to use the cached map outputs %s' % key)
+            shutil.rmtree(output_dir, True)
+            return None
+        return counters
+
+    def put(self, key, output_dir, prefix, counters):
+        '''
+        Adds the outputs of the prefix in output_dir and their counters
+        as the entry of the key, returns False if the key is cached already.
+        '''
+        if not os.path.exists(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                pass
+        entry_path = self._entry_path(key)
+        if os.path.isdir(entry_path):
+            return False
+        tmp_path = tempfile.mkdtemp(prefix='.%s.' % key, dir=self.path)
+        try:
+            for slice_idx, name in _slice_files(output_dir, prefix):
+                _link_or_copy(os.path.join(output_dir, name), os.path.join(tmp_path, str(slice_idx)))
+            with open(os.path.join(tmp_path, COUNTERS_NAME), 'w') as counters_file:
+                json.dump(counters, counters_file, sort_keys=True)
+            os.rename(tmp_path, entry_path)
+        except OSError:
+            # another task added the key meanwhile
+            shutil.rmtree(tmp_path, True)
+            return False
+        return True
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if name.startswith('.'):
+                continue
+            entry_path = self._entry_path(name)
+            try:
+                size = sum(os.path.getsize(os.path.join(entry_path, file_name)) \
+                        for file_name in os.listdir(entry_path))
+                entries.append((os.path.getmtime(entry_path), size, entry_path))
+            except OSError:
+                continue
+        return entries
+
+    def evict(self):
+        '''
+        Removes the least recently used entries until the total size of
+        the entries is at most max_bytes, and returns the number removed.
+        '''
+        if not os.path.isdir(self.path):
+            return 0
+        entries = sorted(self._entries())
+        total = sum(size for mtime, size, entry_path in entries)
+        evicted = 0
+        for mtime, size, entry_path in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry_path, True)
+            total -= size
+            evicted += 1
+        return evicted
+
+def test():
+    class Mapper(object):
+        pass
+
+    path = tempfile.mkdtemp()
+    try:
+        cache = MapOutputCache(os.path.join(path, 'cache'), 100)
+        output_dir = os.path.join(path, 'map_0')
+        os.makedirs(output_dir)
+        for idx in range(2):
+            with open(os.path.join(output_dir, 'map_0_%d' % idx), 'w') as output:
+                output.write('x' * 10)
+        keys = [cache.key(Mapper, {'reducer_num': 2}, 'split_%d' % i) for i in range(2)]
+        print 'stable key: %s' % (keys[0] == cache.key(Mapper, {'reducer_num': 2}, 'split_0'))
+        counters = {'framework': {'input_records': 7}}
+        print 'put: %s, put again: %s' % (cache.put(keys[0], output_dir, 'map_0', counters),
+                cache.put(keys[0], output_dir, 'map_0', counters))
+        print 'get: %s, files: %s' % (cache.get(keys[0], os.path.join(path, 'map_5'), 'map_5') == counters,
+                sorted(os.listdir(os.path.join(path, 'map_5'))))
+        print 'missed: %s' % (cache.get(keys[1], os.path.join(path, 'map_6'), 'map_6') is None)
+        os.utime(cache._entry_path(keys[0]), (0, 0))
+        cache.put(keys[1], output_dir, 'map_0', counters)
+        print 'evicted: %d, expected: 1, kept the newest: %s' % (cache.evict(), os.listdir(cache.path) == [keys[1]])
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == '__main__':
+    test()
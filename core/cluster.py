@@ -0,0 +1,440 @@
+import os
+import sys
+import time
+import socket
+import logging
+import threading
+import traceback
+import collections
+import multiprocessing
+from multiprocessing.connection import Listener, Client
+
+from job import Job, Configure, TaskProgress
+from mapper import BaseMapper
+from reducer import BaseReducer
+from collector import read_kv_file
+
+DEFAULT_AUTHKEY = 'mapred'
+HEARTBEAT_INTERVAL = 1.0
+HEARTBEAT_TIMEOUT = 10.0
+MAX_TASK_ATTEMPTS = 4
+
+# a task is speculated if it has run for SPECULATIVE_MIN_TIME seconds,
+# and its progress rate is less than SPECULATIVE_SLOWNESS of the median
+SPECULATIVE_MIN_TIME = 2.0
+SPECULATIVE_SLOWNESS = 0.5
+
+TASK_PENDING = 'pending'
+TASK_RUNNING = 'running'
+TASK_DONE = 'done'
+
+class Master(object):
+    '''
+    The Master hands the tasks of a phase to the worker daemons over
+    socket RPC. An idle worker asks for a task, runs it and reports the
+    result, so the tasks are scheduled dynamically like on a local pool.
+
+    Each worker also sends heartbeats through a second connection. A
+    worker is dead once its RPC connection is broken or no heartbeat is
+    received for heartbeat_timeout seconds, then the tasks it is running
+    are pending again and rerun by other workers. A task which fails
+    max_task_attempts times fails the phase.
+
+    The heartbeats carry the number of inputs consumed by the running
+    task. In the speculative mode, when there is no pending task for an
+    idle worker, a backup attempt is started for the slowest running
+    task whose progress rate, i.e. the inputs consumed against the size
+    of its inputs per second, is far behind the median. The first attempt
+    finished wins, and the tasks commit their outputs atomically so that
+    the outputs of the other attempt are dropped.
+
+    The workers read and write the data in the work dir and the output
+    path of the job, which must be on a filesystem shared by all the
+    machines.
+    '''
+    def __init__(self, address=('127.0.0.1', 0), authkey=DEFAULT_AUTHKEY,
+            heartbeat_timeout=HEARTBEAT_TIMEOUT, max_task_attempts=MAX_TASK_ATTEMPTS):
+        self.listener = Listener(address, authkey=authkey)
+        self.address = self.listener.address
+        self.heartbeat_timeout = heartbeat_timeout
+        self.max_task_attempts = max_task_attempts
+
+        self.lock = threading.Condition()
+        self.workers = {} # worker id -> time of the last heartbeat
+        self.running = {} # worker id -> the attempt it is running
+        self.phase = None
+        self.states = {}
+        self.pending = collections.deque()
+        self.shutdown = False
+
+    def start(self):
+        for target in (self._accept, self._monitor):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        with self.lock:
+            self.shutdown = True
+            self.lock.notify_all()
+        self.listener.close()
+
+    def _accept(self):
+        while True:
+            try:
+                conn = self.listener.accept()
+            except:
+                if not self.shutdown:
+                    logging.error('The master stops accepting: %s' % traceback.format_exc())
+                return
+            thread = threading.Thread(target=self._handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def _monitor(self):
+        while not self.shutdown:
+            time.sleep(HEARTBEAT_INTERVAL)
+            now = time.time()
+            with self.lock:
+                for worker_id, last_heartbeat in self.workers.items():
+                    if now - last_heartbeat > self.heartbeat_timeout:
+                        logging.warning('worker %s has no heartbeat for %.1f seconds' % \
+                                (worker_id, now - last_heartbeat))
+                        self._lose_worker(worker_id)
+
+    def _running_attempts(self, task_id):
+        return [attempt for attempt in self.running.values() \
+                if attempt['phase'] == self.phase and attempt['task_id'] == task_id]
+
+    def _lose_worker(self, worker_id):
+        '''
+        Forgets a dead worker and makes its task pending again unless
+        another attempt of the task is running, it must be called with
+        the lock held.
+        '''
+        self.workers.pop(worker_id, None)
+        attempt = self.running.pop(worker_id, None)
+        if attempt is None:
+            return
+        task_id = attempt['task_id']
+        if attempt['phase'] == self.phase and self.states.get(task_id) == TASK_RUNNING \
+                and not self._running_attempts(task_id):
+            logging.warning('%s task %d of the dead worker %s is rescheduled' % (self.phase, task_id, worker_id))
+            self.states[task_id] = TASK_PENDING
+            self.pending.appendleft(task_id)
+            self.lock.notify_all()
+
+    def _start_attempt(self, worker_id, task_id):
+        self.states[task_id] = TASK_RUNNING
+        self.attempts[task_id] += 1
+        self.running[worker_id] = {'phase': self.phase, 'task_id': task_id, 'start': time.time(), 'records': 0}
+        task = dict(self.tasks[task_id], attempt=self.attempts[task_id] - 1)
+        return self.phase, task_id, self.task_func, task
+
+    def _speculative_task(self):
+        '''
+        Returns the slowest running task which deserves a backup attempt,
+        or None. The inputs per byte of the finished tasks estimates the
+        number of inputs of a running task from the size of its inputs.
+        '''
+        total_size = sum(size for records, size, duration in self.finished)
+        if total_size <= 0:
+            return None
+        records_per_byte = float(sum(records for records, size, duration in self.finished)) / total_size
+
+        now = time.time()
+        # the finished tasks progressed from 0 to 1 in their durations
+        rates = [1.0 / max(duration, 0.001) for records, size, duration in self.finished]
+        candidates = []
+        for attempt in self.running.values():
+            # a straggler of the last phase may still be running
+            if attempt['phase'] != self.phase:
+                continue
+            task_id = attempt['task_id']
+            size = self.tasks[task_id].get('size')
+            elapsed = now - attempt['start']
+            if size is None or elapsed < SPECULATIVE_MIN_TIME:
+                continue
+            expected = size * records_per_byte
+            progress = min(1.0, attempt['records'] / expected) if expected > 0 else 1.0
+            rates.append(progress / elapsed)
+            if task_id not in self.speculated and len(self._running_attempts(task_id)) == 1:
+                candidates.append((progress / elapsed, task_id))
+
+        median = sorted(rates)[len(rates) / 2]
+        slow_tasks = [(rate, task_id) for rate, task_id in candidates if rate < SPECULATIVE_SLOWNESS * median]
+        if not slow_tasks:
+            return None
+        rate, task_id = min(slow_tasks)
+        logging.info('%s task %d is speculated, its progress rate %.4f, the median %.4f' % \
+                (self.phase, task_id, rate, median))
+        return task_id
+
+    def _next_task(self, worker_id):
+        '''
+        Waits for a pending task or a task to speculate for the worker,
+        returns None if the master is shut down or the worker is dead.
+        '''
+        with self.lock:
+            while not self.shutdown and worker_id in self.workers:
+                if self.phase is not None and self.pending:
+                    return self._start_attempt(worker_id, self.pending.popleft())
+                if self.phase is not None and self.speculative:
+                    task_id = self._speculative_task()
+                    if task_id is not None:
+                        self.speculated.add(task_id)
+                        return self._start_attempt(worker_id, task_id)
+                self.lock.wait(HEARTBEAT_INTERVAL)
+        return None
+
+    def _finish_task(self, worker_id, phase, task_id, succeeded, result, records):
+        with self.lock:
+            attempt = self.running.get(worker_id)
+            if attempt is not None and attempt['phase'] == phase and attempt['task_id'] == task_id:
+                del self.running[worker_id]
+            if phase != self.phase or self.states.get(task_id) == TASK_DONE:
+                return
+            if succeeded:
+                logging.info('%s task %d finished on worker %s' % (phase, task_id, worker_id))
+                self.states[task_id] = TASK_DONE
+                self.results[task_id] = result
+                if attempt is not None and self.tasks[task_id].get('size') is not None:
+                    self.finished.append((records, self.tasks[task_id]['size'], time.time() - attempt['start']))
+            elif self._running_attempts(task_id):
+                logging.warning('%s task %d failed on worker %s, another attempt is running: %s' % \
+                        (phase, task_id, worker_id, result))
+            elif self.attempts[task_id] >= self.max_task_attempts:
+                logging.error('%s task %d failed %d times, the last error: %s' % \
+                        (phase, task_id, self.attempts[task_id], result))
+                self.failed = True
+            else:
+                logging.warning('%s task %d failed on worker %s: %s' % (phase, task_id, worker_id, result))
+                self.states[task_id] = TASK_PENDING
+                self.pending.append(task_id)
+            self.lock.notify_all()
+
+    def _handle(self, conn):
+        worker_id = None
+        try:
+            message = conn.recv()
+            if message[0] == 'heartbeat':
+                self._handle_heartbeats(conn, message[1])
+                return
+
+            worker_id = message[1]
+            with self.lock:
+                self.workers[worker_id] = time.time()
+            logging.info('worker %s registered' % worker_id)
+
+            while True:
+                message = conn.recv()
+                if message[0] == 'request':
+                    task = self._next_task(worker_id)
+                    conn.send(('exit',) if task is None else ('task',) + task)
+                    if task is None:
+                        return
+                elif message[0] == 'done':
+                    self._finish_task(worker_id, message[1], message[2], True, message[3], message[4])
+                elif message[0] == 'failed':
+                    self._finish_task(worker_id, message[1], message[2], False, message[3], message[4])
+        except (EOFError, IOError, socket.error):
+            if worker_id is not None:
+                logging.warning('lost the connection of worker %s' % worker_id)
+        finally:
+            if worker_id is not None:
+                with self.lock:
+                    self._lose_worker(worker_id)
+            conn.close()
+
+    def _handle_heartbeats(self, conn, worker_id):
+        while True:
+            message = conn.recv()
+            with self.lock:
+                # the heartbeats of a dead worker are ignored
+                if worker_id in self.workers:
+                    self.workers[worker_id] = time.time()
+                    if worker_id in self.running:
+                        self.running[worker_id]['records'] = message[2]
+
+    def run_tasks(self, phase, task_func, tasks, speculative=False):
+        '''
+        Runs the tasks of a phase on the workers, it returns the results
+        in a dict by task id after all the tasks are finished, or None if
+        any task failed.
+        '''
+        with self.lock:
+            self.tasks = dict((task['task_id'], task) for task in tasks)
+            self.task_func = task_func
+            self.speculative = speculative
+            self.states = dict((task_id, TASK_PENDING) for task_id in self.tasks)
+            self.attempts = dict((task_id, 0) for task_id in self.tasks)
+            self.pending = collections.deque(sorted(self.tasks))
+            self.speculated = set()
+            self.finished = [] # (inputs, size of the inputs, duration) of the finished tasks
+            self.results = {}
+            self.failed = False
+            self.phase = phase
+            self.lock.notify_all()
+
+            while not self.failed and len(self.results) < len(self.tasks):
+                self.lock.wait(HEARTBEAT_INTERVAL)
+
+            self.phase = None
+            if self.failed:
+                return None
+            return self.results
+
+class ClusterJob(Job):
+    '''
+    The ClusterJob runs the tasks of all the phases on the worker daemons
+    of a Master instead of a local pool, start the workers by
+    run_worker() on any machines which can reach the address of the
+    master, e.g.
+
+        python core/cluster.py worker host:port [worker_num]
+
+    The mapper, reducer and combiner classes must be importable by the
+    workers, and the work dir and output path must be on a filesystem
+    shared by all the machines.
+
+    The straggler tasks are speculated if speculative is True, except
+    the map tasks of the socket shuffle, whose outputs are pushed to
+    the reducers before they are committed.
+    '''
+    def __init__(self, conf, address=('127.0.0.1', 0), authkey=DEFAULT_AUTHKEY,
+            heartbeat_timeout=HEARTBEAT_TIMEOUT, speculative=True):
+        Job.__init__(self, conf)
+        self.master = Master(address, authkey, heartbeat_timeout)
+        self.speculative = speculative
+
+    def _check_env(self):
+        if self.shuffle == 'memory':
+            logging.error('the memory shuffle can not run on the workers of several machines')
+            return False
+        return Job._check_env(self)
+
+    def _run_tasks(self, phase, task_func, tasks, process_num):
+        logging.info('%s phase starts on the workers of %s' % (phase, str(self.master.address)))
+        speculative = self.speculative and not (phase == 'map' and self.shuffle == 'socket')
+        return self.master.run_tasks(phase, task_func, list(tasks), speculative)
+
+    def run(self):
+        self.master.start()
+        try:
+            return Job.run(self)
+        finally:
+            self.master.stop()
+
+class Worker(object):
+    '''
+    The Worker daemon asks the master for tasks and runs them one by one,
+    until the master tells it to exit.
+    '''
+    def __init__(self, address, authkey=DEFAULT_AUTHKEY):
+        if type(address) is str:
+            host, port = address.rsplit(':', 1)
+            address = (host, int(port))
+        self.address = address
+        self.authkey = authkey
+        self.worker_id = '%s:%d' % (socket.gethostname(), os.getpid())
+        self.progress = TaskProgress()
+
+    def _heartbeat(self):
+        conn = Client(self.address, authkey=self.authkey)
+        try:
+            conn.send(('heartbeat', self.worker_id, self.progress.records))
+            while True:
+                time.sleep(HEARTBEAT_INTERVAL)
+                conn.send(('heartbeat', self.worker_id, self.progress.records))
+        except (EOFError, IOError, socket.error):
+            pass
+        finally:
+            conn.close()
+
+    def run(self):
+        conn = Client(self.address, authkey=self.authkey)
+        conn.send(('register', self.worker_id))
+
+        thread = threading.Thread(target=self._heartbeat)
+        thread.daemon = True
+        thread.start()
+
+        try:
+            while True:
+                conn.send(('request',))
+                message = conn.recv()
+                if message[0] == 'exit':
+                    return
+                phase, task_id, task_func, task = message[1:]
+                self.progress = TaskProgress()
+                try:
+                    result = task_func(task, self.progress)[1]
+                    conn.send(('done', phase, task_id, result, self.progress.records))
+                except:
+                    conn.send(('failed', phase, task_id, traceback.format_exc(), self.progress.records))
+        except (EOFError, IOError, socket.error):
+            logging.warning('lost the connection to the master %s' % str(self.address))
+        finally:
+            conn.close()
+
+def run_worker(address, authkey=DEFAULT_AUTHKEY):
+    Worker(address, authkey).run()
+
+class TestMapper(BaseMapper):
+    def map(self, key, value, collector):
+        for word in value.split():
+            collector.collect(word, 1)
+
+class TestReducer(BaseReducer):
+    def reduce(self, key, values, collector):
+        collector.collect(key, sum(values))
+
+def test():
+    import shutil
+    import tempfile
+
+    tmp_path = tempfile.mkdtemp()
+    try:
+        input_dir = os.path.join(tmp_path, 'input')
+        os.mkdir(input_dir)
+        for i in range(4):
+            with open(os.path.join(input_dir, 'file_%d' % i), 'w') as writer:
+                for j in range(1000):
+                    writer.write('apple banana apple cherry\n')
+
+        job = ClusterJob(Configure(os.path.join(tmp_path, 'mapred.conf')))
+        job.set_mapper(TestMapper)
+        job.set_reducer_class(TestReducer)
+        job.set_reducer_num(2)
+        job.set_map_task_num(8)
+        job.add_input_dir(input_dir)
+        job.set_output_path(os.path.join(tmp_path, 'output'))
+
+        # each worker process acts as a node
+        workers = [multiprocessing.Process(target=run_worker, args=(job.master.address,)) for i in range(3)]
+        for worker in workers:
+            worker.start()
+        print 'job succeeded: %s' % job.run()
+        for worker in workers:
+            worker.join()
+
+        output_path = os.path.join(tmp_path, 'output')
+        for name in sorted(os.listdir(output_path)):
+            if name.startswith('_'):
+                continue
+            for key, value in read_kv_file(os.path.join(output_path, name), 'json'):
+                print '%s\t%s' % (key, value)
+        print 'expected: apple\t8000, banana\t4000, cherry\t4000'
+    finally:
+        shutil.rmtree(tmp_path)
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 3 and sys.argv[1] == 'worker':
+        worker_num = int(sys.argv[3]) if len(sys.argv) >= 4 else 1
+        workers = [multiprocessing.Process(target=run_worker, args=(sys.argv[2],)) for i in range(worker_num)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    else:
+        test()
@@ -0,0 +1,303 @@
+import bz2
+import json
+import zlib
+import struct
+import marshal
+import cPickle
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+CODEC = 'codec'
+BLOCK_RECORDS = 'block_records'
+COMPRESSION = 'compression'
+
+DEFAULT_BLOCK_RECORDS = 4096
+
+# the header of each block: flags, length of the payload, checksum of the payload
+BLOCK_HEADER = struct.Struct('<BII')
+FLAG_CHECKSUM = 0x01
+FLAG_ZLIB = 0x02
+FLAG_BZ2 = 0x04
+FLAG_LZMA = 0x08
+FLAG_INDEX = 0x80
+FLAG_COMPRESSIONS = FLAG_ZLIB | FLAG_BZ2 | FLAG_LZMA
+
+# the footer after the index block: magic, offset of the index block
+INDEX_FOOTER = struct.Struct('<4sQ')
+INDEX_MAGIC = 'MRIX'
+
+COMPRESSIONS = {
+        None: 0,
+        'zlib': FLAG_ZLIB,
+        'bz2': FLAG_BZ2,
+        'lzma': FLAG_LZMA,
+        }
+
+def _compress(flag, payload):
+    if flag == FLAG_ZLIB:
+        return zlib.compress(payload, 1)
+    elif flag == FLAG_BZ2:
+        return bz2.compress(payload)
+    return lzma.compress(payload)
+
+def _decompress(flag, payload):
+    if flag == FLAG_ZLIB:
+        return zlib.decompress(payload)
+    elif flag == FLAG_BZ2:
+        return bz2.decompress(payload)
+    elif lzma is None:
+        raise CodecError('The block is compressed by lzma which is not available')
+    return lzma.decompress(payload)
+
+class CodecError(Exception):
+    def __init__(self, msg):
+        self.value = msg
+
+    def __str__(self):
+        return repr(self.value)
+
+class BaseCodec(object):
+    '''
+    A codec serializes k/v pairs into a stream and reads them back,
+    it is shared by the splitters, the collectors, the sorters and
+    the reducers for all the intermediate data of a job.
+
+    writer() wraps a writable stream into an object with the methods
+    write(key, value), flush() and close(), and read() yields the k/v
+    pairs from a readable stream.
+    '''
+    def writer(self, stream):
+        raise NotImplementedError()
+
+    def read(self, stream):
+        raise NotImplementedError()
+
+    def read_index(self, stream):
+        '''
+        Returns the list of (offset, length, number of k/v pairs) of the
+        blocks in a seekable stream, or None if the codec has no blocks.
+        '''
+        return None
+
+    def read_file(self, path):
+        with open(path, 'rb') as stream:
+            for k, v in self.read(stream):
+                yield k, v
+
+class JsonRecordWriter(object):
+    def __init__(self, stream):
+        self.stream = stream
+        self.bytes_written = 0
+
+    def write(self, key, value):
+        line = '%s\n' % json.dumps([key, value])
+        self.stream.write(line)
+        self.bytes_written += len(line)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.stream.close()
+
+class JsonCodec(BaseCodec):
+    '''
+    The JsonCodec writes each k/v pair as a json list [key, value] per
+    line, so that it is human readable and the keys keep their json
+    types, e.g. the int keys are not turned into strings and are sorted
+    as ints, but the tuples are read back as lists. The lines of json
+    objects {key: value} written before are still read. The options of
+    the BinaryCodec are ignored.
+    '''
+    def __init__(self, **options):
+        pass
+
+    def writer(self, stream):
+        return JsonRecordWriter(stream)
+
+    def read(self, stream):
+        for line in stream:
+            record = json.loads(line)
+            if isinstance(record, dict):
+                for k, v in record.items():
+                    yield k, v
+            else:
+                yield record[0], record[1]
+
+class BlockRecordWriter(object):
+    '''
+    The BlockRecordWriter buffers the k/v pairs in memory and writes
+    each block by one call. When it is closed, an index of the blocks
+    is appended, so that readers can seek to any block, see
+    BinaryCodec.read_index() and KVFileSplitter.
+    '''
+    def __init__(self, codec, stream):
+        self.codec = codec
+        self.stream = stream
+        self.records = []
+        self.offset = 0
+        self.index = [] # (offset, length, number of k/v pairs) of each block
+        self.bytes_written = 0
+
+    def write(self, key, value):
+        self.records.append((key, value))
+        if len(self.records) >= self.codec.block_records:
+            self.flush()
+
+    def _write_block(self, block, records_num):
+        self.stream.write(block)
+        self.index.append((self.offset, len(block), records_num))
+        self.offset += len(block)
+        self.bytes_written += len(block)
+
+    def flush(self):
+        if self.records:
+            self._write_block(self.codec.encode_block(self.records), len(self.records))
+            self.records = []
+
+    def close(self):
+        self.flush()
+        index_offset = self.offset
+        index_block = self.codec.encode_block(self.index, FLAG_INDEX)
+        self.stream.write(index_block)
+        self.stream.write(INDEX_FOOTER.pack(INDEX_MAGIC, index_offset))
+        self.bytes_written += len(index_block) + INDEX_FOOTER.size
+        self.stream.close()
+
+class BinaryCodec(BaseCodec):
+    '''
+    The BinaryCodec groups up to block_records k/v pairs into a block,
+    which is serialized by marshal at once, and frames each block by
+    a header holding the length and the optional crc32 checksum of
+    the block. The types of the keys and values are kept, but only
+    the builtin types are supported, see the PickleCodec for others.
+
+    Each block is optionally compressed by zlib, bz2 or lzma (if the
+    lzma module is available), the compression is recorded in the
+    header so the readers need not to know it.
+    '''
+    def __init__(self, block_records=DEFAULT_BLOCK_RECORDS, checksum=True, compression=None):
+        if compression not in COMPRESSIONS:
+            raise CodecError('Unknown compression %s' % str(compression))
+        if compression == 'lzma' and lzma is None:
+            raise CodecError('The lzma module is not available')
+        self.block_records = block_records
+        self.checksum = checksum
+        self.compression = compression
+
+    def dumps(self, records):
+        return marshal.dumps(records)
+
+    def loads(self, payload):
+        return marshal.loads(payload)
+
+    def encode_block(self, records, flags=0):
+        if flags & FLAG_INDEX:
+            payload = marshal.dumps(records)
+        else:
+            payload = self.dumps(records)
+            if self.compression is not None:
+                flags |= COMPRESSIONS[self.compression]
+                payload = _compress(COMPRESSIONS[self.compression], payload)
+        checksum = 0
+        if self.checksum:
+            flags |= FLAG_CHECKSUM
+            checksum = zlib.crc32(payload) & 0xffffffff
+        return BLOCK_HEADER.pack(flags, len(payload), checksum) + payload
+
+    def decode_block(self, flags, payload, checksum):
+        if flags & FLAG_CHECKSUM and zlib.crc32(payload) & 0xffffffff != checksum:
+            raise CodecError('The checksum of the block is mismatched')
+        if flags & FLAG_INDEX:
+            return marshal.loads(payload)
+        if flags & FLAG_COMPRESSIONS:
+            payload = _decompress(flags & FLAG_COMPRESSIONS, payload)
+        return self.loads(payload)
+
+    def _read_block(self, stream):
+        header = stream.read(BLOCK_HEADER.size)
+        if not header:
+            return None, None
+        if len(header) < BLOCK_HEADER.size:
+            raise CodecError('The block header is truncated')
+        flags, length, checksum = BLOCK_HEADER.unpack(header)
+        payload = stream.read(length)
+        if len(payload) < length:
+            raise CodecError('The block is truncated')
+        return flags, self.decode_block(flags, payload, checksum)
+
+    def writer(self, stream):
+        return BlockRecordWriter(self, stream)
+
+    def read(self, stream):
+        while True:
+            flags, records = self._read_block(stream)
+            # the index block is the last block of a file
+            if flags is None or flags & FLAG_INDEX:
+                return
+            for k, v in records:
+                yield k, v
+
+    def read_index(self, stream):
+        '''
+        Returns the list of (offset, length, number of k/v pairs) of the
+        blocks in a seekable stream, or None if the stream has no index.
+        '''
+        stream.seek(0, 2)
+        if stream.tell() < INDEX_FOOTER.size:
+            return None
+        stream.seek(-INDEX_FOOTER.size, 2)
+        magic, index_offset = INDEX_FOOTER.unpack(stream.read(INDEX_FOOTER.size))
+        if magic != INDEX_MAGIC:
+            return None
+        stream.seek(index_offset)
+        flags, index = self._read_block(stream)
+        if flags is None or not flags & FLAG_INDEX:
+            raise CodecError('The index block is invalid')
+        return index
+
+    def read_block(self, stream, offset):
+        '''
+        Returns the k/v pairs of the block at the offset of a seekable
+        stream, the offsets are given by read_index().
+        '''
+        stream.seek(offset)
+        flags, records = self._read_block(stream)
+        if flags is None or flags & FLAG_INDEX:
+            raise CodecError('There is no block at offset %d' % offset)
+        return records
+
+class PickleCodec(BinaryCodec):
+    '''
+    The PickleCodec is like the BinaryCodec except that the blocks are
+    serialized by pickle, so that any picklable keys and values are supported.
+    '''
+    def dumps(self, records):
+        return cPickle.dumps(records, cPickle.HIGHEST_PROTOCOL)
+
+    def loads(self, payload):
+        # cPickle does not load from a buffer
+        return cPickle.loads(str(payload))
+
+CODECS = {
+        'json': JsonCodec,
+        'binary': BinaryCodec,
+        'pickle': PickleCodec,
+        }
+
+DEFAULT_CODEC = 'binary'
+
+def get_codec(codec, **options):
+    '''
+    Returns the codec object for a codec object or the name of a codec,
+    the options are passed to the constructor of a named codec.
+    '''
+    if codec is None:
+        codec = DEFAULT_CODEC
+    if isinstance(codec, BaseCodec):
+        return codec
+    if codec not in CODECS:
+        raise CodecError('Unknown codec %s' % str(codec))
+    return CODECS[codec](**options)
@@ -1,9 +1,27 @@
 import os
 import logging
-import json
 import sys
 import time
+import itertools
 import traceback
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from codec import CODEC, BLOCK_RECORDS, COMPRESSION, DEFAULT_BLOCK_RECORDS, get_codec
+from partitioner import PARTITIONER, get_partitioner
+from shuffle import ShuffleStream, get_client
+from shm import SegmentStream
+from counters import Counters, FRAMEWORK_GROUP
+from sorter import MemoryBudget, record_size, HEAP_FULL, BUDGET_FULL
+
+COMBINE_BUFFER_NUM = 'combine_buffer_num'
+DEFAULT_COMBINE_BUFFER_NUM = 10000
+COMBINE_MIN_RATIO = 'combine_min_ratio'
+DEFAULT_COMBINE_MIN_RATIO = 2.0
+TASK_MEMORY_MB = 'task_memory_mb'
+SEGMENT_QUEUES = 'segment_queues'
 
 class CollectorConfigureError(Exception):
     def __init__(self, msg):
@@ -26,9 +44,35 @@ class BaseCollector(object):
     queue names to identify the output.
     The slice_num is the number of slices this collector
     should partition the outputs.
+    The optional partitioner decides the slice of each key, it is
+    the name of a partitioner or a partitioner object, see
+    partitioner.py. The keys are hashed into slices by default.
+    The optional codec is the name of the codec serializing the
+    outputs, see codec.py. The optional block_records and compression
+    are passed to the codec.
+    The optional combine_buffer_num is the number of k/v pairs
+    buffered for the combiner, and the optional combine_min_ratio is
+    the least ratio of its inputs to its outputs for which the combiner
+    is kept, see set_combiner().
+    The optional task_memory_mb bounds the approximate bytes of the k/v
+    pairs buffered by the combiner and by the heaps of the sorting
+    collectors: once they are exceeded, the combine buffer is flushed
+    and the largest slice of the heaps is spilled, so the number of
+    buffered pairs adapts to their size. The blocks buffered by the
+    codec writers are bounded by block_records instead.
+
+    The counters of the collector count the outputs in the framework
+    group when it is closed, and are shared with the mapper or reducer
+    which outputs to the collector.
     '''
     def __init__(self, conf):
         self.conf = conf
+        self.partitioner = get_partitioner(None if conf is None else conf.get(PARTITIONER))
+        self.combiner = None
+        self.counters = Counters()
+        self.output_records = 0
+        task_memory_mb = None if conf is None else conf.get(TASK_MEMORY_MB)
+        self.memory_budget = MemoryBudget(int(task_memory_mb * (1 << 20))) if task_memory_mb else None
 
     def _check_env(self):
         if self.conf is None or \
@@ -44,12 +88,222 @@ class BaseCollector(object):
         self.slice_num = self.conf['slice_num'] # since slice_num is frequently used
         return True
 
+    def _get_codec(self):
+        return get_codec(self.conf.get(CODEC),
+                block_records=self.conf.get(BLOCK_RECORDS, DEFAULT_BLOCK_RECORDS),
+                compression=self.conf.get(COMPRESSION))
+
+    def set_combiner(self, combiner_class):
+        '''
+        The combiner is a reducer which pre-aggregates the values of
+        the same key before they are serialized, e.g. the values are
+        summed up in word count. The k/v pairs are buffered by key until
+        there are combine_buffer_num pairs, then each key is combined.
+        Collectors which spill the outputs combine them again while
+        spilling.
+        If a flush of the buffer does not reduce the pairs by at least
+        combine_min_ratio, e.g. the keys are mostly distinct, buffering
+        costs more than it saves, so the combine buffer is bypassed for
+        the rest of the outputs and the spills are not combined either,
+        like the min spills of Hadoop.
+        The combiner must output the same key as its input.
+        '''
+        self.combine_collector = CombineCollector()
+        self.combiner = combiner_class(self.combine_collector)
+        if not self.combiner._check_env():
+            raise CollectorConfigureError('The combiner %s is invalid' % str(combiner_class))
+        self.combine_buffer_num = self.conf.get(COMBINE_BUFFER_NUM, DEFAULT_COMBINE_BUFFER_NUM)
+        self.combine_min_ratio = self.conf.get(COMBINE_MIN_RATIO, DEFAULT_COMBINE_MIN_RATIO)
+        self.combine_bypassed = False
+        self.combine_buffer = {}
+        self.combine_count = 0
+        self.combine_bytes = 0
+
+    def _combine(self, key, values):
+        self.combiner.reduce(key, values, self.combine_collector)
+        results = self.combine_collector.results
+        self.combine_collector.results = []
+        self.counters.incr(FRAMEWORK_GROUP, 'combine_input_records', len(values))
+        self.counters.incr(FRAMEWORK_GROUP, 'combine_output_records', len(results))
+        return results
+
+    def _combine_sorted(self, kvs):
+        '''
+        Combines the values of the same key in a sorted k/v iterable,
+        unless the combine buffer is bypassed.
+        '''
+        if self.combiner is None or self.combine_bypassed:
+            return kvs
+        return self._combine_groups(kvs)
+
+    def _combine_groups(self, kvs):
+        for key, group in itertools.groupby(kvs, lambda kv: kv[0]):
+            values = [v for k, v in group]
+            if len(values) == 1:
+                yield key, values[0]
+                continue
+            for kv in self._combine(key, values):
+                yield kv
+
+    def _flush_combine_buffer(self):
+        combine_buffer = self.combine_buffer
+        input_count = self.combine_count
+        self.combine_buffer = {}
+        self.combine_count = 0
+        if self.memory_budget is not None:
+            self.memory_budget.release(self.combine_bytes)
+            self.combine_bytes = 0
+        output_count = 0
+        for key, values in combine_buffer.iteritems():
+            for key, value in self._combine(key, values):
+                self._collect(self.partitioner.partition(key, self.slice_num), key, value)
+                output_count += 1
+        if input_count < output_count * self.combine_min_ratio:
+            self.combine_bypassed = True
+            self.counters.incr(FRAMEWORK_GROUP, 'combine_bypassed')
+
     def collect(self, key, value):
-        channel = hash(key) % self.conf['slice_num']
+        self.output_records += 1
+        if self.combiner is not None and not self.combine_bypassed:
+            if key in self.combine_buffer:
+                self.combine_buffer[key].append(value)
+            else:
+                self.combine_buffer[key] = [value]
+            self.combine_count += 1
+            if self.memory_budget is not None:
+                size = record_size(key, value)
+                self.combine_bytes += size
+                self.memory_budget.acquire(size)
+                if self.memory_budget.exceeded():
+                    self.counters.incr(FRAMEWORK_GROUP, 'budget_full')
+                    self._flush_combine_buffer()
+                    return
+            if self.combine_count >= self.combine_buffer_num:
+                self._flush_combine_buffer()
+            return
+
+        channel = self.partitioner.partition(key, self.conf['slice_num'])
         self._collect(channel, key, value)
 
+    def collect_batch(self, keys, values):
+        '''
+        Collects the k/v pairs of two columns, the keys and the values,
+        which are lists or numpy arrays of the same length. Each distinct
+        key is partitioned only once, and the pairs of each slice are
+        passed to the collector at once. The keys must be hashable.
+        '''
+        if self.combiner is not None and not self.combine_bypassed:
+            # the records are counted by collect()
+            for key, value in itertools.izip(_to_list(keys), _to_list(values)):
+                self.collect(key, value)
+            return
+
+        self.output_records += len(keys)
+        if numpy is not None and isinstance(keys, numpy.ndarray):
+            batches = self._partition_array(keys, values)
+        else:
+            batches = [[] for i in range(self.slice_num)]
+            channels = {}
+            for key, value in itertools.izip(keys, values):
+                if key not in channels:
+                    channels[key] = self.partitioner.partition(key, self.slice_num)
+                batches[channels[key]].append((key, value))
+
+        for channel, kvs in enumerate(batches):
+            if kvs:
+                self._collect_batch(channel, kvs)
+
+    def _partition_array(self, keys, values):
+        '''
+        Partitions the k/v pairs of a numpy array of keys: the distinct
+        keys are partitioned, and the pairs are ordered by the slice by
+        a stable argsort and cut into slices by the bincount.
+        '''
+        distinct_keys, inverse = numpy.unique(keys, return_inverse=True)
+        channels = numpy.array([self.partitioner.partition(key, self.slice_num) \
+                for key in distinct_keys.tolist()], dtype=numpy.int64)[inverse]
+        order = numpy.argsort(channels, kind='mergesort')
+        counts = numpy.bincount(channels, minlength=self.slice_num)
+        keys = keys[order].tolist()
+        if isinstance(values, numpy.ndarray):
+            values = values[order].tolist()
+        else:
+            values = [values[idx] for idx in order.tolist()]
+
+        batches = []
+        start = 0
+        for count in counts.tolist():
+            batches.append(zip(keys[start:start + count], values[start:start + count]))
+            start += count
+        return batches
+
+    def _collect_batch(self, channel, kvs):
+        for key, value in kvs:
+            self._collect(channel, key, value)
+
+    def _check_heap(self, state, channel, spill):
+        '''
+        Spills the slice of a full heap by the spill function, or the
+        largest slice of the heaps if the memory budget is exceeded.
+        '''
+        if state == HEAP_FULL:
+            self.counters.incr(FRAMEWORK_GROUP, 'heap_full')
+            spill(channel)
+        elif state == BUDGET_FULL:
+            channel = self.heap_sorter.largest_slice()
+            if self.heap_sorter.local_results[channel]:
+                self.counters.incr(FRAMEWORK_GROUP, 'budget_full')
+                spill(channel)
+
+    def _count_bytes(self, channel, writer):
+        self.counters.incr(FRAMEWORK_GROUP, 'partition_%d_bytes' % channel, writer.bytes_written)
+
     def close(self):
+        if self.combiner is not None:
+            self._flush_combine_buffer()
         self._close()
+        self.counters.incr(FRAMEWORK_GROUP, 'output_records', self.output_records)
+
+def _to_list(column):
+    if numpy is not None and isinstance(column, numpy.ndarray):
+        return column.tolist()
+    return column
+
+class SampleCollector(BaseCollector):
+    '''
+    The SampleCollector keeps the keys of the outputs in memory,
+    it is used to sample the keys of the mapper outputs.
+    '''
+    def __init__(self):
+        BaseCollector.__init__(self, {'path': 'memory', 'prefix': 'sample', 'slice_num': 1})
+        self.keys = []
+
+    def collect(self, key, value):
+        self.keys.append(key)
+
+    def collect_batch(self, keys, values):
+        self.keys.extend(_to_list(keys))
+
+    def _close(self):
+        pass
+
+class CombineCollector(BaseCollector):
+    '''
+    The CombineCollector keeps the outputs of a combiner in
+    memory, the owner of the combiner takes them away.
+    '''
+    def __init__(self):
+        BaseCollector.__init__(self, {'path': 'memory', 'prefix': 'combiner', 'slice_num': 1})
+        self.results = []
+
+    def collect(self, key, value):
+        self.results.append((key, value))
+
+    def collect_batch(self, keys, values):
+        self.results.extend(itertools.izip(_to_list(keys), _to_list(values)))
+
+    def _close(self):
+        pass
 
 class DebugCollector(BaseCollector):
     '''
@@ -67,6 +321,14 @@ class DebugCollector(BaseCollector):
 class FileCollector(BaseCollector):
     '''
     The FileCollector outputs the k/v to a local file.
+
+    The k/v pairs of each slice are buffered in memory by the
+    writer of the codec, and written as one block of block_records
+    pairs, which is compressed if the compression is given.
+
+    Each slice is written to a hidden temporary file, which is renamed
+    to path/prefix_<slice> when the collector is closed, so a crash
+    never leaves a partial output that looks complete.
     '''
     def __init__(self, conf):
         BaseCollector.__init__(self, conf)
@@ -81,49 +343,245 @@ class FileCollector(BaseCollector):
         else:
             os.mkdir(self.conf['path'])
 
-        self.writers = [open(os.path.join(self.conf['path'], '%s_%d' % (self.conf['prefix'], i)), 'w') for i in range(self.conf['slice_num'])]
+        self.codec = self._get_codec()
+        self.writers = [self.codec.writer(open(self._tmp_path(i), 'wb')) for i in range(self.conf['slice_num'])]
+
+    def _output_path(self, channel):
+        return os.path.join(self.conf['path'], '%s_%d' % (self.conf['prefix'], channel))
+
+    def _tmp_path(self, channel):
+        return os.path.join(self.conf['path'], '.%s_%d.tmp' % (self.conf['prefix'], channel))
+
+    def _commit_slice(self, channel, writer):
+        writer.close()
+        os.rename(self._tmp_path(channel), self._output_path(channel))
+        self._count_bytes(channel, writer)
 
     def _collect(self, channel, key, value):
         if channel >= self.slice_num:
             channel = channel % self.slice_num
-        self.writers[channel].write('%s\n' % json.dumps({key: value}))
+        self.writers[channel].write(key, value)
         
     def _close(self):
-        for writer in self.writers:
-            writer.close()
+        for idx, writer in enumerate(self.writers):
+            self._commit_slice(idx, writer)
+
+def read_kv_file(file_path, codec=None):
+    '''
+    Reads back the k/v pairs written by the FileCollector
+    or the SortFileCollector with the same codec.
+    '''
+    return get_codec(codec).read_file(file_path)
 
 class SocketCollector(BaseCollector):
-    pass
+    '''
+    The SocketCollector sends the k/v of each slice to a ShuffleServer,
+    the path is a list of the addresses (host:port) of the servers, one
+    for each slice, and the prefix is the name of the stream sent to
+    each server. A block is sent as soon as block_records k/v pairs of
+    a slice are collected, so the shuffle is overlapped with the map.
+    The connections are shared by all the collectors of a process.
+    '''
+    def __init__(self, conf):
+        BaseCollector.__init__(self, conf)
+        if not self._check_env() or \
+                type(self.conf['path']) is not list or \
+                len(self.conf['path']) != self.slice_num:
+            logging.error('The configure of %s is invalid' % self.__class__.__name__)
+            raise CollectorConfigureError('The configure of %s is invalid' % self.__class__.__name__)
+
+        self.codec = self._get_codec()
+        self.clients = [get_client(address) for address in self.conf['path']]
+        self.stream_nums = [0] * self.slice_num
+        self.writers = [None] * self.slice_num
 
-from sorter import HeapSorter, HEAP_FULL
+    def _open_stream(self, channel):
+        name = '%s_%d' % (self.conf['prefix'], self.stream_nums[channel])
+        self.stream_nums[channel] += 1
+        return self.codec.writer(ShuffleStream(self.clients[channel], name))
+
+    def _collect(self, channel, key, value):
+        if channel >= self.slice_num:
+            channel = channel % self.slice_num
+        if self.writers[channel] is None:
+            self.writers[channel] = self._open_stream(channel)
+        self.writers[channel].write(key, value)
+
+    def _close(self):
+        for idx, writer in enumerate(self.writers):
+            if writer is not None:
+                writer.close()
+                self._count_bytes(idx, writer)
+        # the outputs are not delivered until the servers acknowledge them
+        for client in self.clients:
+            client.flush()
+
+class SharedMemoryCollector(BaseCollector):
+    '''
+    The SharedMemoryCollector writes the k/v of each slice into segments
+    under the path, which should be on a shared memory filesystem, e.g.
+    /dev/shm, see shm.py, so that the outputs are passed to the reducers
+    on the same machine without the disk round trip.
+
+    The segment_queues is a list of queues, e.g. of a multiprocessing
+    Manager, one for each slice. The descriptor of each segment is put
+    into the queue of its slice once the segment is written, and the
+    reducer maps the segments into memory by read_segment().
+    '''
+    def __init__(self, conf):
+        BaseCollector.__init__(self, conf)
+        if not self._check_env() or \
+                not os.path.isdir(self.conf['path']) or \
+                type(self.conf.get(SEGMENT_QUEUES)) is not list or \
+                len(self.conf[SEGMENT_QUEUES]) != self.slice_num:
+            logging.error('The configure of %s is invalid' % self.__class__.__name__)
+            raise CollectorConfigureError('The configure of %s is invalid' % self.__class__.__name__)
+
+        self.codec = self._get_codec()
+        self.queues = self.conf[SEGMENT_QUEUES]
+        self.segment_nums = [0] * self.slice_num
+        self.writers = [None] * self.slice_num
+
+    def _open_segment(self, channel):
+        name = '%s_%d_%d' % (self.conf['prefix'], channel, self.segment_nums[channel])
+        self.segment_nums[channel] += 1
+        return self.codec.writer(SegmentStream(self.conf['path'], name, self.queues[channel]))
+
+    def _collect(self, channel, key, value):
+        if channel >= self.slice_num:
+            channel = channel % self.slice_num
+        if self.writers[channel] is None:
+            self.writers[channel] = self._open_segment(channel)
+        self.writers[channel].write(key, value)
+
+    def _close(self):
+        for idx, writer in enumerate(self.writers):
+            if writer is not None:
+                writer.close()
+                self._count_bytes(idx, writer)
+
+from sorter import HeapSorter, SequentMergeSorter, DEFAULT_MERGE_FACTOR
 MAX_RESULTS_NUM = 'max_results_num'
+MERGE_FACTOR = 'merge_factor'
 
 class SortFileCollector(FileCollector):
     '''
     The SortFileCollector is like the FileCollector except
-    that the outputs are partially sorted by keys.
+    that the outputs are sorted by keys.
+
+    At most max_results_num k/v pairs of each slice are kept
+    in memory, once the limit is reached they are spilled to
+    a sorted file, and all the spilled files of a slice are
+    merged into the output by a SequentMergeSorter when the
+    collector is closed.
+    If task_memory_mb is given, the largest slice is also spilled
+    whenever the pairs of all the slices exceed it.
     '''
     def __init__(self, conf):
         FileCollector.__init__(self, conf)
-        self.heap_sorter = HeapSorter(conf['slice_num'])
+        self.heap_sorter = HeapSorter(conf['slice_num'], self.memory_budget)
         if MAX_RESULTS_NUM in conf:
             self.heap_sorter.set_max_result_num(conf[MAX_RESULTS_NUM])
+        merge_factor = conf.get(MERGE_FACTOR, DEFAULT_MERGE_FACTOR)
+        self.merge_sorters = [SequentMergeSorter(conf['path'], '%s_%d' % (conf['prefix'], i), merge_factor, self.codec) \
+                for i in range(conf['slice_num'])]
 
     def _collect(self, channel, key, value):
         if channel >= self.slice_num:
             channel = channel % self.slice_num
-        if HEAP_FULL == self.heap_sorter.add(channel, key, value):
-            for (key, value) in self.heap_sorter.get_all_results(channel):
-                self.writers[channel].write('%s\n' % json.dumps({key: value}))
+        self._check_heap(self.heap_sorter.add(channel, key, value), channel, self._spill)
+
+    def _collect_batch(self, channel, kvs):
+        self._check_heap(self.heap_sorter.add_batch(channel, kvs), channel, self._spill)
+
+    def _spill(self, channel):
+        self.merge_sorters[channel].spill(self._combine_sorted(self.heap_sorter.get_all_results(channel)))
+        self.counters.incr(FRAMEWORK_GROUP, 'spills')
 
     def _close(self):
         for idx, writer in enumerate(self.writers):
-            for key, value in self.heap_sorter.get_all_results(idx):
-                writer.write('%s\n' % json.dumps({key: value}))
-            writer.close()
+            merge_sorter = self.merge_sorters[idx]
+            if merge_sorter.runs:
+                self._spill(idx)
+                results = merge_sorter.get_all_results()
+            else:
+                results = self.heap_sorter.get_all_results(idx)
+            for key, value in self._combine_sorted(results):
+                writer.write(key, value)
+            self._commit_slice(idx, writer)
 
 class SortSocketCollector(SocketCollector):
-    pass
+    '''
+    The SortSocketCollector is like the SocketCollector except that
+    each stream sent is sorted by keys.
+
+    At most max_results_num k/v pairs of each slice are kept in memory,
+    once the limit is reached they are sorted and sent as a new stream,
+    so that the receiver gets a number of sorted streams from each
+    mapper, which are merged by the reducer.
+    '''
+    def __init__(self, conf):
+        SocketCollector.__init__(self, conf)
+        self.heap_sorter = HeapSorter(conf['slice_num'], self.memory_budget)
+        if MAX_RESULTS_NUM in conf:
+            self.heap_sorter.set_max_result_num(conf[MAX_RESULTS_NUM])
+
+    def _send_sorted(self, channel):
+        writer = self._open_stream(channel)
+        for key, value in self._combine_sorted(self.heap_sorter.get_all_results(channel)):
+            writer.write(key, value)
+        writer.close()
+        self._count_bytes(channel, writer)
+
+    def _collect(self, channel, key, value):
+        if channel >= self.slice_num:
+            channel = channel % self.slice_num
+        self._check_heap(self.heap_sorter.add(channel, key, value), channel, self._send_sorted)
+
+    def _collect_batch(self, channel, kvs):
+        self._check_heap(self.heap_sorter.add_batch(channel, kvs), channel, self._send_sorted)
+
+    def _close(self):
+        for idx in range(self.slice_num):
+            if self.heap_sorter.local_results[idx]:
+                self._send_sorted(idx)
+        for client in self.clients:
+            client.flush()
+
+class SortSharedMemoryCollector(SharedMemoryCollector):
+    '''
+    The SortSharedMemoryCollector is like the SharedMemoryCollector
+    except that each segment is sorted by keys.
+
+    At most max_results_num k/v pairs of each slice are kept in memory,
+    once the limit is reached they are sorted and written as a new
+    segment, and the sorted segments are merged by the reducer.
+    '''
+    def __init__(self, conf):
+        SharedMemoryCollector.__init__(self, conf)
+        self.heap_sorter = HeapSorter(conf['slice_num'], self.memory_budget)
+        if MAX_RESULTS_NUM in conf:
+            self.heap_sorter.set_max_result_num(conf[MAX_RESULTS_NUM])
+
+    def _write_sorted(self, channel):
+        writer = self._open_segment(channel)
+        for key, value in self._combine_sorted(self.heap_sorter.get_all_results(channel)):
+            writer.write(key, value)
+        writer.close()
+        self._count_bytes(channel, writer)
+
+    def _collect(self, channel, key, value):
+        if channel >= self.slice_num:
+            channel = channel % self.slice_num
+        self._check_heap(self.heap_sorter.add(channel, key, value), channel, self._write_sorted)
+
+    def _collect_batch(self, channel, kvs):
+        self._check_heap(self.heap_sorter.add_batch(channel, kvs), channel, self._write_sorted)
+
+    def _close(self):
+        for idx in range(self.slice_num):
+            if self.heap_sorter.local_results[idx]:
+                self._write_sorted(idx)
 
 def test_sortfile_collector():
     # setup
@@ -143,6 +601,32 @@ def test_sortfile_collector():
     print conf
     tear_down(tmp_path)
 
+def test_memory_budget():
+    # setup
+    tmp_path = setup()
+
+    # testing
+    try:
+        # 1000 values of 1KB do not fit in 0.5MB, so the slices are spilled by size
+        conf = {'path': tmp_path, 'prefix': 'test_budget', 'slice_num': 2,
+                MAX_RESULTS_NUM: 1000000, TASK_MEMORY_MB: 0.5}
+        collector = SortFileCollector(conf)
+        collector._check_env()
+        for i in range(1000):
+            collector.collect('key_%03d' % i, 'v' * 1024)
+        collector.close()
+        print 'budget_full: %d, expected: > 0' % collector.counters.get(FRAMEWORK_GROUP, 'budget_full')
+        print 'used: %d, expected: 0' % collector.memory_budget.used
+        print 'outputs: %d, expected: 1000' % sum(len(list(read_kv_file(os.path.join(tmp_path, name)))) \
+                for name in os.listdir(tmp_path) if not name.startswith('.'))
+    except:
+        print traceback.format_exc()
+
+    # tear down
+    for name in os.listdir(tmp_path):
+        os.remove(os.path.join(tmp_path, name))
+    os.rmdir(tmp_path)
+
 def test_file_collector():
     # setup
     tmp_path = setup()
@@ -173,8 +657,8 @@ def tear_down(tmp_path):
     for file in os.listdir(tmp_path):
         print '===%s==' % file
         file_path = os.path.join(tmp_path, file)
-        for line in open(file_path):
-            print '\t%s' % line[:-1]
+        for key, value in read_kv_file(file_path):
+            print '\t%s\t%s' % (key, value)
         os.remove(file_path)
     os.rmdir(tmp_path)
 
@@ -188,3 +672,4 @@ if __name__ == '__main__':
 #    test_debug_collector()
 #    test_file_collector()
     test_sortfile_collector()
+    test_memory_budget()
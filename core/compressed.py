@@ -0,0 +1,282 @@
+import os
+import bz2
+import zlib
+import struct
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+GZIP = 'gzip'
+BZIP2 = 'bz2'
+XZ = 'xz'
+
+EXTENSIONS = {
+        '.gz': GZIP,
+        '.gzip': GZIP,
+        '.bgz': GZIP,
+        '.bgzf': GZIP,
+        '.bz2': BZIP2,
+        '.xz': XZ,
+        }
+
+MAGICS = (('\x1f\x8b', GZIP), ('BZh', BZIP2), ('\xfd7zXZ\x00', XZ))
+
+CHUNK_SIZE = 64 * 1024
+
+# the fixed header of a gzip member up to XLEN, see RFC 1952
+GZIP_HEADER = struct.Struct('<BBBBIBBH')
+GZIP_FEXTRA = 4
+# the BGZF subfield holding the size of the block less 1
+BGZF_SUBFIELD = struct.Struct('<ccHH')
+
+class CompressionError(Exception):
+    def __init__(self, msg):
+        self.value = msg
+
+    def __str__(self):
+        return repr(self.value)
+
+def detect_format(path):
+    '''
+    Returns the compression format of a file by its extension, or else
+    by its magic bytes, or None if the file is not compressed.
+    '''
+    fmt = EXTENSIONS.get(os.path.splitext(path)[1].lower())
+    if fmt is not None:
+        return fmt
+    with open(path, 'rb') as stream:
+        head = stream.read(6)
+    for magic, fmt in MAGICS:
+        if head.startswith(magic):
+            return fmt
+    return None
+
+def _bgzf_block_size(stream):
+    '''
+    Returns the size of the BGZF block at the position of the stream, or
+    None if there is no block or it is a plain gzip member.
+    '''
+    header = stream.read(GZIP_HEADER.size)
+    if len(header) < GZIP_HEADER.size:
+        return None
+    id1, id2, cm, flags, mtime, xfl, os_type, xlen = GZIP_HEADER.unpack(header)
+    if (id1, id2) != (0x1f, 0x8b) or not flags & GZIP_FEXTRA:
+        return None
+    extra = stream.read(xlen)
+    pos = 0
+    while pos + BGZF_SUBFIELD.size <= len(extra):
+        si1, si2, slen, bsize = BGZF_SUBFIELD.unpack_from(extra, pos)
+        if (si1, si2, slen) == ('B', 'C', 2):
+            return bsize + 1
+        pos += 4 + slen
+    return None
+
+def is_bgzf(path):
+    '''
+    Tells whether a gzip file is made of BGZF blocks, i.e. gzip members
+    whose headers hold their sizes, so that the file can be split at the
+    blocks without decompressing it.
+    '''
+    with open(path, 'rb') as stream:
+        return _bgzf_block_size(stream) is not None
+
+def bgzf_blocks(path):
+    '''
+    Yields the (offset, size) of each BGZF block by reading the headers.
+    '''
+    file_size = os.path.getsize(path)
+    with open(path, 'rb') as stream:
+        offset = 0
+        while offset < file_size:
+            stream.seek(offset)
+            size = _bgzf_block_size(stream)
+            if size is None:
+                raise CompressionError('%s is not a BGZF file at offset %d' % (path, offset))
+            yield offset, size
+            offset += size
+
+def _decompressor(fmt):
+    if fmt == GZIP:
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if fmt == BZIP2:
+        return bz2.BZ2Decompressor()
+    if lzma is None:
+        raise CompressionError('the lzma module is required to read the xz files')
+    return lzma.LZMADecompressor()
+
+def decompress_members(stream, fmt):
+    '''
+    Decompresses the members of a multi-member file from the position of
+    the stream, e.g. the concatenated gzip members or bz2 streams, and
+    yields (offset, pos, data) for each decompressed chunk, the offset is
+    that of its member in the file and pos that of the data in the member.
+    '''
+    offset = position = stream.tell()
+    decompressor = _decompressor(fmt)
+    member_pos = 0
+    for chunk in iter(lambda: stream.read(CHUNK_SIZE), ''):
+        while chunk:
+            try:
+                data = decompressor.decompress(chunk)
+                unused = decompressor.unused_data
+            except EOFError:
+                # the bz2 and lzma decompressors refuse any data after their stream
+                data, unused = '', chunk
+            if data:
+                yield offset, member_pos, data
+                member_pos += len(data)
+            position += len(chunk) - len(unused)
+            chunk = ''
+            if unused:
+                if not unused.strip('\x00'):
+                    # the padding at the end of a file
+                    return
+                offset = position
+                decompressor = _decompressor(fmt)
+                member_pos = 0
+                chunk = unused
+    if fmt == GZIP:
+        data = decompressor.flush()
+        if data:
+            yield offset, member_pos, data
+
+def open_input(path):
+    '''
+    Returns an iterator over the lines of a file, which is decompressed
+    on the fly if it is compressed.
+    '''
+    fmt = detect_format(path)
+    if fmt is None:
+        return open(path)
+    return _iter_lines(path, fmt)
+
+def _iter_lines(path, fmt):
+    with open(path, 'rb') as stream:
+        pending = ''
+        for offset, pos, data in decompress_members(stream, fmt):
+            lines = (pending + data).split('\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line + '\n'
+        if pending:
+            yield pending
+
+def _read_lines(chunks, end, skip, virtual):
+    '''
+    Yields the (key, line) of the lines starting in the members before
+    end, the key is the BGZF virtual offset of the line if virtual, or
+    else its offset in the decompressed data. If skip, the first line is
+    skipped since it starts in a member before the chunks.
+    '''
+    pending = None # the key and the pieces of a line started in a former chunk
+    total = 0
+    for offset, pos, data in chunks:
+        start = 0
+        if skip:
+            line_end = data.find('\n')
+            if line_end < 0:
+                total += len(data)
+                continue
+            start = line_end + 1
+            skip = False
+        while start <= len(data):
+            line_end = data.find('\n', start)
+            if pending is not None:
+                if line_end < 0:
+                    pending[1].append(data[start:])
+                    break
+                pending[1].append(data[start:line_end])
+                yield pending[0], ''.join(pending[1])
+                pending = None
+                start = line_end + 1
+                continue
+            if offset >= end or start == len(data):
+                break
+            key = (offset << 16) | (pos + start) if virtual else total + start
+            if line_end < 0:
+                pending = [key, [data[start:]]]
+                break
+            yield key, data[start:line_end]
+            start = line_end + 1
+        if offset >= end and pending is None:
+            return
+        total += len(data)
+    if pending is not None:
+        yield pending[0], ''.join(pending[1])
+
+def read_range(path, offset, length, prev_offset=None):
+    '''
+    Yields the (key, line) of the lines starting in a range of a
+    compressed file. A range of a BGZF file is made of whole blocks, and
+    prev_offset is that of the block before the range, which tells if
+    the first line of the range starts in a former range. The other
+    compressed files can only be read as a whole.
+    '''
+    fmt = detect_format(path)
+    bgzf = fmt == GZIP and is_bgzf(path)
+    if not bgzf and (offset != 0 or length < os.path.getsize(path)):
+        raise CompressionError('%s can not be split since it is not a BGZF file' % path)
+    with open(path, 'rb') as stream:
+        skip = False
+        if prev_offset is not None:
+            stream.seek(prev_offset)
+            for member_offset, pos, data in decompress_members(stream, fmt):
+                if member_offset != prev_offset:
+                    break
+                skip = not data.endswith('\n')
+        stream.seek(offset)
+        for kv in _read_lines(decompress_members(stream, fmt), offset + length, skip, bgzf):
+            yield kv
+
+def test():
+    import gzip
+    import shutil
+    import tempfile
+    path = tempfile.mkdtemp()
+    try:
+        lines = ['line %d %s' % (i, 'x' * (i % 50)) for i in range(2000)]
+        text = ''.join(line + '\n' for line in lines)
+
+        # a multi-member gzip file whose members break the lines
+        gzip_path = os.path.join(path, 'input.gz')
+        with open(gzip_path, 'wb') as output:
+            for start in range(0, len(text), 1000):
+                compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                output.write(compressor.compress(text[start:start + 1000]) + compressor.flush())
+        print 'gzip lines: %s' % ([line[:-1] for line in open_input(gzip_path)] == lines)
+
+        bz2_path = os.path.join(path, 'input')
+        with open(bz2_path, 'wb') as output:
+            output.write(bz2.compress(text[:5000]) + bz2.compress(text[5000:]))
+        print 'bz2 by magic: %s, lines: %s' % (detect_format(bz2_path) == BZIP2,
+                [line for key, line in read_range(bz2_path, 0, os.path.getsize(bz2_path))] == lines)
+
+        # a BGZF file, whose blocks are split into ranges of 3 blocks
+        bgzf_path = os.path.join(path, 'input.bgz')
+        with open(bgzf_path, 'wb') as output:
+            for start in range(0, len(text), 1000):
+                compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+                payload = compressor.compress(text[start:start + 1000]) + compressor.flush()
+                header = GZIP_HEADER.pack(0x1f, 0x8b, 8, GZIP_FEXTRA, 0, 0, 255, BGZF_SUBFIELD.size)
+                block_size = len(header) + BGZF_SUBFIELD.size + len(payload) + 8
+                output.write(header + BGZF_SUBFIELD.pack('B', 'C', 2, block_size - 1) + payload)
+                output.write(struct.pack('<II', zlib.crc32(text[start:start + 1000]) & 0xffffffff,
+                        len(text[start:start + 1000])))
+        blocks = list(bgzf_blocks(bgzf_path))
+        got = []
+        for idx in range(0, len(blocks), 3):
+            ranges = blocks[idx:idx + 3]
+            prev_offset = blocks[idx - 1][0] if idx > 0 else None
+            got.extend(read_range(bgzf_path, ranges[0][0], sum(size for offset, size in ranges), prev_offset))
+        print 'bgzf blocks: %d, lines: %s, distinct keys: %s' % (len(blocks), [line for key, line in got] == lines,
+                len(set(key for key, line in got)) == len(lines))
+        print 'gzip module reads bgzf: %s' % (gzip.open(bgzf_path).read() == text)
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,169 @@
+import os
+import json
+import time
+import logging
+import threading
+import BaseHTTPServer
+
+FRAMEWORK_GROUP = 'framework'
+
+class Counters(object):
+    '''
+    The Counters keeps named counters in groups, e.g. the framework
+    group counts the records and bytes of a task, and the mappers and
+    reducers may count anything in their own groups. The counters of
+    the tasks are sent back with the results of the tasks and added
+    up by the job.
+    '''
+    def __init__(self, groups=None):
+        self.groups = {}
+        if groups is not None:
+            self.merge(groups)
+
+    def incr(self, group, name, amount=1):
+        counters = self.groups.get(group)
+        if counters is None:
+            counters = self.groups[group] = {}
+        counters[name] = counters.get(name, 0) + amount
+
+    def get(self, group, name):
+        return self.groups.get(group, {}).get(name, 0)
+
+    def merge(self, other):
+        '''
+        Adds up the counters of another Counters or of its to_dict().
+        '''
+        if isinstance(other, Counters):
+            other = other.groups
+        for group, counters in other.iteritems():
+            for name, amount in counters.iteritems():
+                self.incr(group, name, amount)
+
+    def to_dict(self):
+        return dict((group, dict(counters)) for group, counters in self.groups.iteritems())
+
+def cpu_time():
+    '''
+    Returns the user and system CPU seconds of the current process.
+    '''
+    times = os.times()
+    return times[0] + times[1]
+
+class Stopwatch(object):
+    '''
+    The Stopwatch measures the wall and CPU seconds of a task since it
+    is created, report() returns them with the counters of the task,
+    which is the result of a task sent back to the job.
+    '''
+    def __init__(self):
+        self.wall = time.time()
+        self.cpu = cpu_time()
+
+    def report(self, counters, **results):
+        report = {'wall_seconds': time.time() - self.wall,
+                  'cpu_seconds': cpu_time() - self.cpu,
+                  'counters': counters.to_dict()}
+        report.update(results)
+        return report
+
+class JobReport(object):
+    '''
+    The JobReport collects the wall and CPU seconds and the counters of
+    each phase of a job. The CPU seconds of a phase are those of the job
+    process plus those of all the tasks of the phase.
+    '''
+    def __init__(self):
+        self.start = time.time()
+        self.phases = []
+        self.running_phase = None
+        self.succeeded = None
+
+    def start_phase(self, phase):
+        self.running_phase = phase
+        return Stopwatch()
+
+    def finish_phase(self, phase, stopwatch, task_reports):
+        counters = Counters()
+        task_cpu = 0.0
+        for task_report in task_reports:
+            counters.merge(task_report['counters'])
+            task_cpu += task_report['cpu_seconds']
+        self.phases.append({'phase': phase,
+                            'wall_seconds': time.time() - stopwatch.wall,
+                            'cpu_seconds': cpu_time() - stopwatch.cpu + task_cpu,
+                            'tasks': len(task_reports),
+                            'counters': counters.to_dict()})
+        self.running_phase = None
+
+    def add_profile(self, phase, stage_times):
+        '''
+        Adds the seconds spent in each stage of the framework by the
+        tasks of a finished phase, see profiler.py.
+        '''
+        for phase_report in self.phases:
+            if phase_report['phase'] == phase:
+                phase_report['profile'] = stage_times
+
+    def to_dict(self):
+        return {'succeeded': self.succeeded,
+                'running_phase': self.running_phase,
+                'wall_seconds': time.time() - self.start,
+                'phases': list(self.phases)}
+
+    def write(self, path):
+        with open(path, 'w') as report_file:
+            json.dump(self.to_dict(), report_file, indent=2, sort_keys=True)
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = json.dumps(self.server.report.to_dict(), sort_keys=True)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug('metrics: ' + format % args)
+
+class MetricsServer(object):
+    '''
+    The MetricsServer serves the JobReport of a running job as json
+    over http on the host and port, the port is chosen by the system
+    if it is 0, see address.
+    '''
+    def __init__(self, report, host='127.0.0.1', port=0):
+        self.server = BaseHTTPServer.HTTPServer((host, port), MetricsHandler)
+        self.server.report = report
+        self.address = self.server.server_address
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def test():
+    import urllib2
+
+    counters = Counters()
+    counters.incr(FRAMEWORK_GROUP, 'records', 3)
+    counters.merge({FRAMEWORK_GROUP: {'records': 2}, 'user': {'bad_lines': 1}})
+    print 'counters: %s, expected: records 5, bad_lines 1' % counters.to_dict()
+
+    report = JobReport()
+    stopwatch = report.start_phase('map')
+    report.finish_phase('map', stopwatch, [Stopwatch().report(counters)] * 2)
+    server = MetricsServer(report)
+    server.start()
+    try:
+        metrics = json.load(urllib2.urlopen('http://%s:%d/' % server.address))
+        print 'metrics: %s, expected: records 10' % metrics['phases'][0]['counters']
+    finally:
+        server.stop()
+
+if __name__ == '__main__':
+    test()
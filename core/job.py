@@ -1,10 +1,33 @@
 import os
 import json
+import math
+import inspect
+import logging
+import random
+import shutil
+import cProfile
+import tempfile
+import itertools
+import traceback
 import multiprocessing
 
 from splitter import BaseSplitter, LineSplitter
 from mapper import BaseMapper
 from reducer import BaseReducer
+from collector import FileCollector, SortFileCollector, SortSocketCollector, SortSharedMemoryCollector, \
+        SampleCollector, read_kv_file, MAX_RESULTS_NUM, MERGE_FACTOR, COMBINE_BUFFER_NUM, \
+        DEFAULT_COMBINE_BUFFER_NUM, COMBINE_MIN_RATIO, DEFAULT_COMBINE_MIN_RATIO, SEGMENT_QUEUES, TASK_MEMORY_MB
+from sorter import ConcurrentMergeSorter, SequentMergeSorter, DEFAULT_MAX_RESULTS_NUM, DEFAULT_MERGE_FACTOR, \
+        merge_sorted, write_run
+from partitioner import PARTITIONER, DEFAULT_PARTITIONER, RangePartitioner, SaltingPartitioner
+from sketch import KeySketch
+from counters import Counters, Stopwatch, JobReport, MetricsServer, FRAMEWORK_GROUP
+from profiler import stage_times, merge_profiles
+from shuffle import ShuffleServer, format_address, stop_server
+from shm import shm_path, drain_segments, read_segment
+from cache import MapOutputCache, fingerprint
+from manifest import JobManifest
+from codec import CODEC, DEFAULT_CODEC, BLOCK_RECORDS, DEFAULT_BLOCK_RECORDS, COMPRESSION, get_codec
 
 SPLITTER_CLASS = 'splitter_class'
 MAPPER_CLASS = 'mapper_class'
@@ -13,6 +36,32 @@ MAPPER_NUM = 'mapper_num'
 REDUCER_NUM = 'reducer_num'
 INPUT_DIRS = 'input_dirs'
 OUTPUT_PATH = 'output_path'
+MAP_TASK_NUM = 'map_task_num'
+COMBINER_CLASS = 'combiner_class'
+OUTPUT_CODEC = 'output_codec'
+TOTAL_ORDER = 'total_order'
+SAMPLE_NUM = 'sample_num'
+SHUFFLE = 'shuffle'
+SHUFFLE_HOST = 'shuffle_host'
+SKEW = 'skew'
+SKEW_THRESHOLD = 'skew_threshold'
+REPORT_PATH = 'report_path'
+METRICS_PORT = 'metrics_port'
+PROFILE = 'profile'
+MAP_CACHE_PATH = 'map_cache_path'
+MAP_CACHE_MB = 'map_cache_mb'
+RESUME = 'resume'
+
+WORK_DIR_NAME = '_temporary'
+ATTEMPT_DIR_NAME = '_attempts'
+HOT_DIR_NAME = '_hot'
+REPORT_NAME = '_report.json'
+PROFILE_DIR_NAME = '_profiles'
+MANIFEST_DIR_NAME = '_manifest'
+SUCCESS_NAME = '_SUCCESS'
+
+# the phases whose finished tasks are recorded in the manifest of a resumable job
+RECORDED_PHASES = ('map', 'reduce', 'merge')
 
 class Configure(object):
     def __init__(self, conf_file):
@@ -24,6 +73,30 @@ class Configure(object):
                 REDUCER_NUM: multiprocessing.cpu_count() + 1,
                 INPUT_DIRS: None,
                 OUTPUT_PATH: None,
+                MAP_TASK_NUM: None,
+                MAX_RESULTS_NUM: DEFAULT_MAX_RESULTS_NUM,
+                MERGE_FACTOR: DEFAULT_MERGE_FACTOR,
+                COMBINER_CLASS: None,
+                COMBINE_BUFFER_NUM: DEFAULT_COMBINE_BUFFER_NUM,
+                COMBINE_MIN_RATIO: DEFAULT_COMBINE_MIN_RATIO,
+                TASK_MEMORY_MB: None,
+                CODEC: DEFAULT_CODEC,
+                OUTPUT_CODEC: 'json',
+                BLOCK_RECORDS: DEFAULT_BLOCK_RECORDS,
+                COMPRESSION: None,
+                PARTITIONER: DEFAULT_PARTITIONER,
+                TOTAL_ORDER: False,
+                SAMPLE_NUM: 1000,
+                SHUFFLE: 'file',
+                SHUFFLE_HOST: '127.0.0.1',
+                SKEW: False,
+                SKEW_THRESHOLD: 0.5,
+                REPORT_PATH: None,
+                METRICS_PORT: None,
+                PROFILE: False,
+                MAP_CACHE_PATH: None,
+                MAP_CACHE_MB: 1024,
+                RESUME: False,
                         }
         
         if not os.path.exists(conf_file):
@@ -31,20 +104,9 @@ class Configure(object):
             return None
 
         conf_dict = json.load(open(conf_file))
-        if SPLITTER_CLASS in conf_dict:
-            self.conf_map[SPLITTER_CLASS] = conf_dict[SPLITTER_CLASS]
-        if MAPPER_CLASS in conf_dict:
-            self.conf_map[MAPPER_CLASS] = conf_dict[MAPPER_CLASS]
-        if MAPPER_NUM in conf_dict:
-            self.conf_map[MAPPER_NUM] = conf_dict[MAPPER_NUM]
-        if REDUCER_CLASS in conf_dict:
-            self.conf_map[REDUCER_CLASS] = conf_dict[REDUCER_CLASS]
-        if REDUCER_NUM in conf_dict:
-            self.conf_map[REDUCER_NUM] = conf_dict[REDUCER_NUM]
-        if INPUT_DIRS in conf_dict:
-            self.conf_map[INPUT_DIRS] = conf_dict[INPUT_DIRS]
-        if OUTPUT_PATH in conf_dict:
-            self.conf_map[OUTPUT_PATH] = conf_dict[OUTPUT_PATH]
+        for key in self.conf_map:
+            if key in conf_dict:
+                self.conf_map[key] = conf_dict[key]
 
     def __getitem__(self, key):
         if key not in self.conf_map:
@@ -57,6 +119,267 @@ class DefaultConfigure(Configure):
     def __init__(self):
         Configure.__init__(self, './conf/mapred.conf')
 
+class TaskProgress(object):
+    '''
+    The TaskProgress counts the inputs consumed by a running task,
+    the scheduler compares the progress of the tasks by it.
+    '''
+    def __init__(self):
+        self.records = 0
+
+def _track_progress(kvs, progress):
+    if progress is None:
+        return kvs
+    return _count_records(kvs, progress)
+
+def _count_records(kvs, progress):
+    for kv in kvs:
+        progress.records += 1
+        yield kv
+
+def _attempt_dir(task):
+    '''
+    Each attempt of a task writes its outputs into its own dir, so that
+    several attempts of a task can run at the same time.
+    '''
+    return os.path.join(task['attempt_path'], '%s.%d' % (task['name'], task.get('attempt', 0)))
+
+def _commit_dir(attempt_dir, commit_dir):
+    '''
+    Commits the outputs of an attempt by renaming its dir, only the first
+    attempt succeeds since a dir can not be renamed onto a non-empty dir.
+    '''
+    try:
+        os.rename(attempt_dir, commit_dir)
+        return True
+    except OSError:
+        shutil.rmtree(attempt_dir, True)
+        return False
+
+def _commit_files(attempt_dir, commit_dir):
+    '''
+    Commits the outputs of an attempt by linking its files into the commit
+    dir, only the first attempt succeeds since a link can not overwrite a file.
+    The outputs of the former runs are removed before the tasks are run, see
+    Job._clean_last_run() and Job._recorded_tasks(), so an existing file is
+    always committed by another attempt of the same run.
+    '''
+    committed = True
+    for name in os.listdir(attempt_dir):
+        try:
+            os.link(os.path.join(attempt_dir, name), os.path.join(commit_dir, name))
+        except OSError:
+            committed = False
+    shutil.rmtree(attempt_dir, True)
+    return committed
+
+def _run_recorded_task(task, progress=None):
+    '''
+    Runs in a worker process of the pool: runs the task by its
+    recorded_func, and records its report in the manifest of the job
+    once its outputs are committed.
+    '''
+    task_id, report = task['recorded_func'](task, progress)
+    task['manifest'].finish_task(task['phase'], task_id, report)
+    return task_id, report
+
+def _run_profiled_task(task, progress=None):
+    '''
+    Runs in a worker process of the pool: runs the task by its
+    task_func under cProfile, and dumps the profile into the
+    profile_path of the task.
+    '''
+    profiler = cProfile.Profile()
+    result = profiler.runcall(task['task_func'], task, progress)
+    profiler.dump_stats(os.path.join(task['profile_path'],
+            'task_%d.%d.prof' % (task['task_id'], task.get('attempt', 0))))
+    return result
+
+def _map(task, inputs, collector_conf, progress):
+    '''
+    Maps the inputs into a collector of the collector_conf, and returns
+    the counters of the collector.
+    '''
+    collector = task['collector_class'](collector_conf)
+    if task['combiner_class'] is not None:
+        collector.set_combiner(task['combiner_class'])
+    mapper = task['mapper_class'](collector)
+    mapper.set_inputs(_track_progress(inputs, progress))
+    mapper.run()
+    collector.close()
+    return collector.counters
+
+def _map_cached(task, key, inputs, collector_conf, progress):
+    '''
+    Links the cached outputs of the key into the path of the collector_conf,
+    or maps the inputs into it and caches the outputs if the key is not
+    cached, and returns the counters of the mapping.
+    '''
+    map_cache = task['map_cache']
+    cached_counters = map_cache.get(key, collector_conf['path'], collector_conf['prefix'])
+    if cached_counters is not None:
+        counters = Counters(cached_counters)
+        counters.incr(FRAMEWORK_GROUP, 'map_cache_hits')
+        return counters
+    counters = _map(task, inputs, collector_conf, progress)
+    map_cache.put(key, collector_conf['path'], collector_conf['prefix'], counters.to_dict())
+    counters.incr(FRAMEWORK_GROUP, 'map_cache_misses')
+    return counters
+
+def _map_ranges(task, ranges, collector_conf, progress):
+    '''
+    Maps each range of the input files read by the split apart, so that
+    the outputs of each range are cached by the fingerprint of the range
+    and reused however the ranges are packed into the splits. The sorted
+    outputs of the ranges are then merged into the outputs of the split.
+    '''
+    splitter_class = task['splitter_class']
+    counters = Counters()
+    range_dirs = []
+    if not os.path.exists(collector_conf['path']):
+        os.makedirs(collector_conf['path'])
+    for idx, (file, file_range) in enumerate(ranges):
+        range_conf = dict(collector_conf, path=os.path.join(collector_conf['path'], '.range_%d' % idx))
+        key = task['map_cache'].key(task['cache_key'], splitter_class.range_fingerprint(file, file_range))
+        inputs = splitter_class.read_file_range(file, file_range, task['codec'])
+        counters.merge(_map_cached(task, key, inputs, range_conf, progress))
+        range_dirs.append(range_conf['path'])
+
+    codec = get_codec(collector_conf[CODEC], block_records=collector_conf[BLOCK_RECORDS],
+            compression=collector_conf[COMPRESSION])
+    for slice_idx in range(collector_conf['slice_num']):
+        name = '%s_%d' % (collector_conf['prefix'], slice_idx)
+        merge_sorter = SequentMergeSorter(collector_conf['path'], name, collector_conf[MERGE_FACTOR], codec)
+        for range_dir in range_dirs:
+            merge_sorter.add_run(os.path.join(range_dir, name))
+        write_run(os.path.join(collector_conf['path'], name), merge_sorter.get_all_results(), codec)
+    for range_dir in range_dirs:
+        shutil.rmtree(range_dir, True)
+    return counters
+
+def _run_map_task(task, progress=None):
+    '''
+    Runs in a worker process of the pool: maps one data partition
+    produced by the splitter and partitions the sorted outputs into
+    one file per reducer. If the map cache is given, the outputs of
+    each range of the input files are cached, or else those of the
+    whole partition if it holds the input data itself.
+    '''
+    stopwatch = Stopwatch()
+    collector_conf = task['collector_conf']
+    if task['commit_path'] is not None:
+        collector_conf = dict(collector_conf, path=_attempt_dir(task))
+    splitter_class = task['splitter_class']
+    ranges = None
+    if task.get('map_cache') is not None:
+        ranges = splitter_class.split_ranges(task['split_path'], task['codec'])
+    if ranges is not None:
+        counters = _map_ranges(task, ranges, collector_conf, progress)
+    else:
+        inputs = splitter_class.read_split(task['split_path'], task['codec'])
+        if task.get('map_cache') is not None:
+            key = task['map_cache'].key(task['cache_key'],
+                    splitter_class.split_fingerprint(task['split_path'], task['codec']))
+            counters = _map_cached(task, key, inputs, collector_conf, progress)
+        else:
+            counters = _map(task, inputs, collector_conf, progress)
+    if task['commit_path'] is not None:
+        if not _commit_dir(collector_conf['path'], task['commit_path']):
+            logging.info('%s is committed by another attempt' % task['name'])
+    return task['task_id'], stopwatch.report(counters)
+
+def _sample(inputs, sample_num, seed):
+    '''
+    Returns sample_num inputs chosen evenly from all the inputs by the
+    reservoir sampling, in their order, so that the sample of sorted or
+    time ordered inputs is not only their start.
+    '''
+    rand = random.Random(seed)
+    reservoir = []
+    for idx, kv in enumerate(inputs):
+        if idx < sample_num:
+            reservoir.append((idx, kv))
+        else:
+            slot = rand.randint(0, idx)
+            if slot < sample_num:
+                reservoir[slot] = (idx, kv)
+    reservoir.sort()
+    return [kv for idx, kv in reservoir]
+
+def _run_sample_task(task, progress=None):
+    '''
+    Runs in a worker process of the pool: maps sample_num inputs sampled
+    from one data partition, and returns the keys of the outputs and the
+    KeySketch of the keys, each of which is None unless the task asks
+    for it.
+    '''
+    stopwatch = Stopwatch()
+    collector = SampleCollector()
+    mapper = task['mapper_class'](collector)
+    inputs = task['splitter_class'].read_split(task['split_path'], task['codec'])
+    mapper.set_inputs(_sample(inputs, task['sample_num'], task['task_id']))
+    mapper.run()
+    sketch = None
+    if task['sketch']:
+        sketch = KeySketch()
+        sketch.update(collector.keys)
+    return task['task_id'], stopwatch.report(collector.counters,
+            keys=collector.keys if task['keys'] else None, sketch=sketch)
+
+def _reduce_inputs(task, merge_dir, progress):
+    '''
+    Returns the sorted k/v iterables merged by a reduce task. The socket
+    and the memory shuffles send a sorted stream or segment for each spill
+    of the mappers, so there may be many more of them than the mappers. If there are more than
+    merge_factor inputs, they are merged merge_factor at a time into runs
+    under the merge_dir by a SequentMergeSorter, so that at most
+    merge_factor inputs are opened at the same time.
+    '''
+    read = read_segment if task['shuffle'] == 'memory' else read_kv_file
+    inputs = [_track_progress(read(input_path, task['codec']), progress) for input_path in task['input_paths']]
+    merge_factor = task['merge_factor']
+    if task['shuffle'] == 'file' or len(inputs) <= merge_factor:
+        return inputs
+    os.makedirs(merge_dir)
+    merge_sorter = SequentMergeSorter(merge_dir, 'input', merge_factor, task['codec'])
+    for start in xrange(0, len(inputs), merge_factor):
+        merge_sorter.spill(merge_sorted(inputs[start:start + merge_factor]))
+    return [merge_sorter.get_all_results()]
+
+def _run_reduce_task(task, progress=None):
+    '''
+    Runs in a worker process of the pool: merges the sorted outputs of
+    all mappers for one partition, and reduces them group by group.
+    '''
+    stopwatch = Stopwatch()
+    if progress is None:
+        progress = TaskProgress()
+    merge_dir = _attempt_dir(task) + '.merge'
+    collector_conf = dict(task['collector_conf'], path=_attempt_dir(task))
+    collector = FileCollector(collector_conf)
+    reducer = task['reducer_class'](collector)
+    hot_collector = None
+    if task['hot_keys']:
+        # the partial outputs of the hot keys are merged by the merge pass
+        hot_conf = dict(task['hot_conf'], path=_attempt_dir(task) + '.hot')
+        hot_collector = SortFileCollector(hot_conf)
+        reducer.set_hot_keys(task['hot_keys'], hot_collector)
+    try:
+        merge_sorter = ConcurrentMergeSorter(_reduce_inputs(task, merge_dir, progress))
+        reducer.set_inputs(merge_sorter.get_all_groups())
+        reducer.run()
+    finally:
+        shutil.rmtree(merge_dir, True)
+    collector.close()
+    if hot_collector is not None:
+        hot_collector.close()
+        _commit_files(hot_conf['path'], task['hot_conf']['path'])
+        collector.counters.merge(hot_collector.counters)
+    if not _commit_files(collector_conf['path'], task['commit_path']):
+        logging.info('%s is committed by another attempt' % task['name'])
+    collector.counters.incr(FRAMEWORK_GROUP, 'input_records', progress.records)
+    return task['task_id'], stopwatch.report(collector.counters)
+
 class Job(object):
     def __init__(self, conf):
         self.conf = conf
@@ -68,9 +391,33 @@ class Job(object):
         self.reducer_num = conf[REDUCER_NUM]
         self.input_dirs = conf[INPUT_DIRS]
         self.output_path = conf[OUTPUT_PATH]
+        self.map_task_num = conf[MAP_TASK_NUM]
+        self.max_results_num = conf[MAX_RESULTS_NUM]
+        self.merge_factor = conf[MERGE_FACTOR]
+        self.combiner_class = conf[COMBINER_CLASS]
+        self.combine_buffer_num = conf[COMBINE_BUFFER_NUM]
+        self.combine_min_ratio = conf[COMBINE_MIN_RATIO]
+        self.task_memory_mb = conf[TASK_MEMORY_MB]
+        self.codec = conf[CODEC]
+        self.output_codec = conf[OUTPUT_CODEC]
+        self.block_records = conf[BLOCK_RECORDS]
+        self.compression = conf[COMPRESSION]
+        self.partitioner = conf[PARTITIONER]
+        self.total_order = conf[TOTAL_ORDER]
+        self.sample_num = conf[SAMPLE_NUM]
+        self.shuffle = conf[SHUFFLE]
+        self.shuffle_host = conf[SHUFFLE_HOST]
+        self.skew = conf[SKEW]
+        self.skew_threshold = conf[SKEW_THRESHOLD]
+        self.report_path = conf[REPORT_PATH]
+        self.metrics_port = conf[METRICS_PORT]
+        self.profile = conf[PROFILE]
+        self.map_cache_path = conf[MAP_CACHE_PATH]
+        self.map_cache_mb = conf[MAP_CACHE_MB]
+        self.resume = conf[RESUME]
 
-    def set_splitter(self, spliter):
-        self.splitter = splitter
+    def set_splitter(self, splitter_class):
+        self.splitter_class = splitter_class
 
     def set_mapper(self, mapper_class):
         self.mapper_class = mapper_class
@@ -81,11 +428,197 @@ class Job(object):
     def set_reducer_class(self, reducer_class):
         self.reducer_class = reducer_class
 
+    def set_combiner_class(self, combiner_class):
+        '''
+        The combiner is a reducer run on the map outputs before they are
+        written, it must be able to reduce its own outputs again, e.g.
+        a reducer summing up the values.
+        '''
+        self.combiner_class = combiner_class
+
+    def set_combine_buffer_num(self, combine_buffer_num):
+        self.combine_buffer_num = combine_buffer_num
+
+    def set_combine_min_ratio(self, combine_min_ratio):
+        '''
+        A map task stops combining its outputs if the combiner does not
+        reduce a flush of the combine buffer by at least the ratio of
+        combine_min_ratio, 0 keeps the combiner on, see set_combiner()
+        of collector.py.
+        '''
+        self.combine_min_ratio = combine_min_ratio
+
     def set_reducer_num(self, reducer_num):
         self.reducer_num = reducer_num
 
+    def set_map_task_num(self, map_task_num):
+        '''
+        The map_task_num is the number of data partitions the splitter
+        generates, which are scheduled dynamically onto the mapper_num
+        mapper processes. It is mapper_num by default.
+        '''
+        self.map_task_num = map_task_num
+
+    def set_max_results_num(self, max_results_num):
+        '''
+        The max_results_num is the number of map outputs of each
+        partition kept in memory before they are spilled to disk.
+        '''
+        self.max_results_num = max_results_num
+
+    def set_task_memory_mb(self, task_memory_mb):
+        '''
+        The task_memory_mb is the approximate MB of the k/v pairs each
+        task buffers for sorting and combining, the largest buffer is
+        spilled once it is exceeded. The max_results_num and the
+        combine_buffer_num still apply, they may be raised to let the
+        budget decide when to spill.
+        '''
+        self.task_memory_mb = task_memory_mb
+
+    def set_merge_factor(self, merge_factor):
+        '''
+        The merge_factor is the max number of spilled files merged at once,
+        also the max number of inputs read at once by a reducer.
+        '''
+        self.merge_factor = merge_factor
+
+    def set_codec(self, codec):
+        '''
+        The codec serializes the intermediate data, i.e. the data
+        partitions, the spills and the map outputs, see codec.py.
+        '''
+        self.codec = codec
+
+    def set_partitioner(self, partitioner):
+        '''
+        The partitioner sends each map output to a reducer, it is the
+        name of a partitioner or a partitioner object, e.g. a
+        RangePartitioner, see partitioner.py.
+        '''
+        self.partitioner = partitioner
+
+    def set_total_order(self, total_order, sample_num=None):
+        '''
+        In the total order mode, sample_num inputs sampled from each data
+        partition are mapped to sample the keys, and the map outputs are
+        sent to the reducers by a RangePartitioner splitting the sampled
+        keys evenly, so the outputs of the reducers are in order one
+        after another, like the TeraSort of hadoop. The partitioner of
+        the job is ignored in this mode.
+        '''
+        self.total_order = total_order
+        if sample_num is not None:
+            self.sample_num = sample_num
+
+    def set_shuffle(self, shuffle, shuffle_host=None):
+        '''
+        The shuffle is the way the map outputs are delivered to the
+        reducers, i.e. file, socket or memory. In the file shuffle, the
+        mappers write the outputs to the work dir, which the reducers read
+        after the map phase. In the socket shuffle, a ShuffleServer is
+        started on the shuffle_host for each reducer, and the mappers push
+        the outputs to the servers while they are running. In the memory
+        shuffle, the mappers write the outputs into segments of the
+        shared memory, which the reducers map into memory, it only works
+        when all the tasks run on one machine.
+        '''
+        self.shuffle = shuffle
+        if shuffle_host is not None:
+            self.shuffle_host = shuffle_host
+
+    def set_skew(self, skew, skew_threshold=None):
+        '''
+        In the skew mode, sample_num inputs sampled from each data
+        partition are mapped, and the keys are counted by sketches to
+        find the hot keys, each of which is more than skew_threshold of
+        the share of a reducer. The values of a hot key are spread over
+        several reducers by a SaltingPartitioner, and the partial outputs
+        are reduced again by a final merge pass. So the reducer must be
+        able to reduce its own outputs like a combiner, and the keys must
+        be hashable. The skew mode does not work with the total order mode.
+        '''
+        self.skew = skew
+        if skew_threshold is not None:
+            self.skew_threshold = skew_threshold
+
+    def set_report_path(self, report_path):
+        '''
+        The report of the job is written to the report_path in json,
+        which is _report.json under the output path by default. It has
+        the wall and CPU seconds and the counters of each phase.
+        '''
+        self.report_path = report_path
+
+    def set_metrics_port(self, metrics_port):
+        '''
+        If the metrics_port is given, the report of the running job is
+        served over http on the port of localhost, the port is chosen by
+        the system if it is 0, see metrics_server.address.
+        '''
+        self.metrics_port = metrics_port
+
+    def set_profile(self, profile):
+        '''
+        In the profile mode, each task is run under cProfile, the
+        profiles of the tasks of each phase are merged into
+        _profile_<phase>.prof under the output path, and the seconds
+        spent in each stage of the framework, i.e. split, read, map,
+        collect, sort, merge and reduce, are added to the report.
+        '''
+        self.profile = profile
+
+    def set_map_cache(self, map_cache_path, map_cache_mb=None):
+        '''
+        The outputs of the map tasks are cached in the local dir
+        map_cache_path by the fingerprints of their inputs, of the code
+        of the mapper and the combiner and of the partitioning, so that
+        the inputs unchanged since a previous run are not mapped again.
+        The outputs of each range of the RangeSplitter and its subclasses
+        are cached apart, so adding files only maps the new files, while
+        the splits of the other splitters are cached as a whole.
+        The least recently used outputs are removed once the cache holds
+        more than map_cache_mb. It only works with the file shuffle.
+        '''
+        self.map_cache_path = map_cache_path
+        if map_cache_mb is not None:
+            self.map_cache_mb = map_cache_mb
+
+    def set_resume(self, resume):
+        '''
+        In the resume mode, the finished tasks are recorded in a manifest
+        in the work dir, which is kept if the job fails, so that the job
+        run again with the same inputs and options skips the splitting
+        and the tasks already finished. It only works with the file
+        shuffle.
+        '''
+        self.resume = resume
+
+    def set_block_records(self, block_records):
+        '''
+        The block_records is the number of map outputs of each partition
+        buffered in memory and written as one block.
+        '''
+        self.block_records = block_records
+
+    def set_compression(self, compression):
+        '''
+        The compression of the blocks of the map outputs and the spills,
+        i.e. None, zlib, bz2 or lzma.
+        '''
+        self.compression = compression
+
+    def set_output_codec(self, output_codec):
+        '''
+        The output_codec serializes the outputs of the reducers,
+        it is json by default so that the outputs are readable.
+        '''
+        self.output_codec = output_codec
+
     def add_input_dir(self, input_dir):
-        self.input_dirs.extends(input_dir)
+        if self.input_dirs is None:
+            self.input_dirs = []
+        self.input_dirs.append(input_dir)
 
     def set_output_path(self, output_path):
         self.output_path = output_path
@@ -103,6 +636,11 @@ class Job(object):
             logging.error('%s is not a subclass of BaseReducer' % str(self.reducer_class))
             return False
 
+        if self.combiner_class is not None and \
+                not issubclass(self.combiner_class, BaseReducer):
+            logging.error('%s is not a subclass of BaseReducer' % str(self.combiner_class))
+            return False
+
         if type(self.mapper_num) is not int or self.mapper_num <= 0:
             logging.error('mapper number %s is invalid' % str(self.mapper_num))
             return False
@@ -111,11 +649,514 @@ class Job(object):
             logging.error('reducer number %s is invalide' % str(self.reducer_num))
             return False
 
+        if self.map_task_num is None:
+            self.map_task_num = self.mapper_num
+        if type(self.map_task_num) is not int or self.map_task_num <= 0:
+            logging.error('map task number %s is invalid' % str(self.map_task_num))
+            return False
+
+        if not self.input_dirs:
+            logging.error('no input dir is given')
+            return False
+
+        if not self.output_path:
+            logging.error('no output path is given')
+            return False
+
+        if self.task_memory_mb is not None and \
+                (type(self.task_memory_mb) not in (int, float) or self.task_memory_mb <= 0):
+            logging.error('task memory %s is invalid' % str(self.task_memory_mb))
+            return False
+
+        if self.shuffle not in ('file', 'socket', 'memory'):
+            logging.error('shuffle %s is invalid' % str(self.shuffle))
+            return False
+
+        if self.skew and self.total_order:
+            logging.error('the skew mode can not work with the total order mode')
+            return False
+
+        if self.map_cache_path is not None and self.shuffle != 'file':
+            logging.error('the map cache only works with the file shuffle')
+            return False
+
+        if self.resume and self.shuffle != 'file':
+            logging.error('the resume mode only works with the file shuffle')
+            return False
+
         return True
 
+    def _split(self):
+        '''
+        Splits all the input dirs into map_task_num data partitions,
+        and returns the paths of the partitions.
+        '''
+        split_paths = [os.path.join(self.work_dir, 'split_%d' % i) for i in range(self.map_task_num)]
+        outputers = [open(split_path, 'wb') for split_path in split_paths]
+        # the bytes of each partition, shared by the splitters of all the input dirs
+        partitions = [(0, idx) for idx in range(self.map_task_num)]
+        try:
+            for input_dir in self.input_dirs:
+                splitter = self.splitter_class(input_dir, outputers, self.map_task_num)
+                splitter.set_codec(self.codec)
+                splitter.set_partitions(partitions)
+                if not splitter.split():
+                    logging.error('failed to split the input %s' % input_dir)
+                    return None
+        finally:
+            for outputer in outputers:
+                outputer.close()
+        return split_paths
+
+    def _sample_tasks(self, split_paths):
+        for idx, split_path in enumerate(split_paths):
+            yield {'task_id': idx,
+                   'splitter_class': self.splitter_class,
+                   'split_path': split_path,
+                   'codec': self.codec,
+                   'mapper_class': self.mapper_class,
+                   'sample_num': self.sample_num,
+                   'keys': self.total_order,
+                   'sketch': self.skew}
+
+    def _sample_partitioner(self, split_paths):
+        '''
+        Returns the RangePartitioner of the total order mode, or the
+        SaltingPartitioner of the skew mode if there is any hot key,
+        or None if the sampling failed.
+        '''
+        results = self._run_phase('sample', _run_sample_task,
+                self._sample_tasks(split_paths), self.mapper_num)
+        if results is None:
+            return None
+
+        partitioner = self.partitioner
+        if self.total_order:
+            keys = list(itertools.chain.from_iterable(result['keys'] for result in results.values()))
+            partitioner = RangePartitioner.from_samples(keys, self.reducer_num)
+            logging.info('%d keys are sampled, the split points are %s' % (len(keys), str(partitioner.split_points)))
+        if self.skew:
+            hot_keys = self._hot_keys([result['sketch'] for result in results.values()])
+            if hot_keys:
+                partitioner = SaltingPartitioner(partitioner, hot_keys)
+        return partitioner
+
+    def _hot_keys(self, sketches):
+        '''
+        Merges the sketches of the sample tasks, and returns a dict of the
+        number of reducers which the values of each hot key are spread over.
+        '''
+        sketch = sketches[0]
+        for other in sketches[1:]:
+            sketch.merge(other)
+        min_count = max(self.skew_threshold * sketch.total / self.reducer_num, 1.0)
+
+        hot_keys = {}
+        for key, count in sketch.hot_keys(min_count).iteritems():
+            fanout = min(self.reducer_num, int(math.ceil(count / min_count)))
+            if fanout > 1:
+                hot_keys[key] = fanout
+        logging.info('%d keys are sketched, the hot keys are %s' % (sketch.total, str(hot_keys)))
+        return hot_keys
+
+    def _start_shuffle_servers(self):
+        '''
+        Starts a ShuffleServer process for each reducer, the outputs
+        for the reducer are received into the shuffle dir of the reducer.
+        '''
+        self.shuffle_processes = []
+        self.shuffle_addresses = []
+        for idx in range(self.reducer_num):
+            server = ShuffleServer(self._shuffle_dir(idx), self.shuffle_host)
+            process = multiprocessing.Process(target=server.serve_forever)
+            process.daemon = True
+            process.start()
+            # the socket is served by the child process
+            server.close()
+            self.shuffle_processes.append(process)
+            self.shuffle_addresses.append(format_address(server.address))
+
+    def _stop_shuffle_servers(self):
+        for address, process in zip(self.shuffle_addresses, self.shuffle_processes):
+            if process.is_alive():
+                stop_server(address)
+            process.join()
+
+    def _start_segment_queues(self):
+        '''
+        Creates the segment dir in the shared memory and a queue for each
+        reducer, into which the mappers put the descriptors of the segments.
+        '''
+        self.segment_dir = tempfile.mkdtemp(prefix='mapred_', dir=shm_path())
+        self.segment_manager = multiprocessing.Manager()
+        self.segment_queues = [self.segment_manager.Queue() for idx in range(self.reducer_num)]
+
+    def _stop_segment_queues(self):
+        self.segment_descriptors = [drain_segments(queue) for queue in self.segment_queues]
+        self.segment_manager.shutdown()
+
+    def _shuffle_dir(self, reducer_idx):
+        return os.path.join(self.work_dir, 'shuffle_%d' % reducer_idx)
+
+    def _map_cache_key(self, partitioner):
+        '''
+        Returns the fingerprint of everything but the split which decides
+        the outputs of a map task.
+        '''
+        return self.map_cache.key(self.splitter_class, self.mapper_class, self.combiner_class,
+                partitioner, self.reducer_num, self.codec, self.compression)
+
+    def _map_tasks(self, split_paths, partitioner):
+        cache_key = self._map_cache_key(partitioner) if self.map_cache is not None else None
+        if self.shuffle == 'socket':
+            collector_class, path = SortSocketCollector, self.shuffle_addresses
+        elif self.shuffle == 'memory':
+            collector_class, path = SortSharedMemoryCollector, self.segment_dir
+        else:
+            collector_class, path = SortFileCollector, self.work_dir
+        for idx, split_path in enumerate(split_paths):
+            yield {'task_id': idx,
+                   'name': 'map_%d' % idx,
+                   'size': self.splitter_class.split_size(split_path, self.codec),
+                   'attempt_path': self.attempt_dir,
+                   'commit_path': self._map_output_dir(idx) if self.shuffle == 'file' else None,
+                   'splitter_class': self.splitter_class,
+                   'split_path': split_path,
+                   'codec': self.codec,
+                   'mapper_class': self.mapper_class,
+                   'combiner_class': self.combiner_class,
+                   'map_cache': self.map_cache,
+                   'cache_key': cache_key,
+                   'collector_class': collector_class,
+                   'collector_conf': {'path': path,
+                                      'prefix': 'map_%d' % idx,
+                                      'slice_num': self.reducer_num,
+                                      PARTITIONER: partitioner,
+                                      CODEC: self.codec,
+                                      BLOCK_RECORDS: self.block_records,
+                                      COMPRESSION: self.compression,
+                                      MAX_RESULTS_NUM: self.max_results_num,
+                                      MERGE_FACTOR: self.merge_factor,
+                                      COMBINE_BUFFER_NUM: self.combine_buffer_num,
+                                      COMBINE_MIN_RATIO: self.combine_min_ratio,
+                                      TASK_MEMORY_MB: self.task_memory_mb,
+                                      SEGMENT_QUEUES: self.segment_queues if self.shuffle == 'memory' else None}}
+
+    def _reduce_input_paths(self, idx):
+        if self.shuffle == 'socket':
+            shuffle_dir = self._shuffle_dir(idx)
+            return [os.path.join(shuffle_dir, name) for name in sorted(os.listdir(shuffle_dir)) \
+                    if not name.startswith('.')]
+        if self.shuffle == 'memory':
+            return [path for path, length in self.segment_descriptors[idx]]
+        return [os.path.join(self._map_output_dir(m), 'map_%d_%d' % (m, idx)) for m in range(self.map_task_num)]
+
+    def _map_output_dir(self, map_idx):
+        return os.path.join(self.work_dir, 'map_%d' % map_idx)
+
+    def _reduce_tasks(self):
+        for idx in range(self.reducer_num):
+            input_paths = self._reduce_input_paths(idx)
+            yield {'task_id': idx,
+                   'name': 'reduce_%d' % idx,
+                   'size': sum(os.path.getsize(input_path) for input_path in input_paths),
+                   'attempt_path': self.attempt_dir,
+                   'commit_path': self.output_path,
+                   'input_paths': input_paths,
+                   'shuffle': self.shuffle,
+                   'merge_factor': self.merge_factor,
+                   'codec': self.codec,
+                   'reducer_class': self.reducer_class,
+                   'hot_keys': frozenset(self.hot_keys),
+                   'hot_conf': {'path': self._hot_dir(),
+                                'prefix': 'hot_%d' % idx,
+                                'slice_num': self.reducer_num,
+                                PARTITIONER: self.home_partitioner,
+                                CODEC: self.codec,
+                                TASK_MEMORY_MB: self.task_memory_mb},
+                   'collector_conf': {'path': self.output_path,
+                                      'prefix': 'part_%05d' % idx,
+                                      'slice_num': 1,
+                                      CODEC: self.output_codec}}
+
+    def _hot_dir(self):
+        return os.path.join(self.work_dir, HOT_DIR_NAME)
+
+    def _merge_tasks(self):
+        '''
+        The merge pass reduces the partial outputs of the hot keys again,
+        there is a merge task for each reducer the hot keys belong to,
+        which merges the partial outputs from all the reducers.
+        '''
+        homes = sorted(set(self.home_partitioner.partition(key, self.reducer_num) for key in self.hot_keys))
+        for idx in homes:
+            input_paths = [os.path.join(self._hot_dir(), 'hot_%d_%d' % (r, idx)) for r in range(self.reducer_num)]
+            yield {'task_id': idx,
+                   'name': 'merge_%d' % idx,
+                   'size': sum(os.path.getsize(input_path) for input_path in input_paths),
+                   'attempt_path': self.attempt_dir,
+                   'commit_path': self.output_path,
+                   'input_paths': input_paths,
+                   'shuffle': 'file',
+                   'merge_factor': self.merge_factor,
+                   'codec': self.codec,
+                   'reducer_class': self.reducer_class,
+                   'hot_keys': None,
+                   'hot_conf': None,
+                   'collector_conf': {'path': self.output_path,
+                                      'prefix': 'part_hot_%05d' % idx,
+                                      'slice_num': 1,
+                                      CODEC: self.output_codec}}
+
+    def _run_tasks(self, phase, task_func, tasks, process_num):
+        '''
+        Schedules the tasks dynamically onto a pool of process_num
+        processes: an idle process takes the next pending task, so that
+        fast processes are never blocked by slow ones. It returns after
+        all the tasks are finished, which is the barrier between phases.
+
+        The results of the tasks are returned in a dict by task id,
+        or None is returned if any task failed.
+        '''
+        results = {}
+        pool = multiprocessing.Pool(process_num)
+        try:
+            for task_id, result in pool.imap_unordered(task_func, tasks, 1):
+                logging.info('%s task %d finished' % (phase, task_id))
+                results[task_id] = result
+            pool.close()
+        except:
+            logging.error('%s phase failed: %s' % (phase, traceback.format_exc()))
+            pool.terminate()
+            return None
+        finally:
+            pool.join()
+        return results
+
+    def _run_phase(self, phase, task_func, tasks, process_num):
+        '''
+        Runs the tasks of a phase by _run_tasks(), and adds the timings
+        and the counters of the phase to the report of the job.
+        '''
+        stopwatch = self.report.start_phase(phase)
+        finished = {}
+        if self.manifest is not None and phase in RECORDED_PHASES:
+            finished = self.manifest.finished_tasks(phase)
+            if finished:
+                logging.info('%d %s tasks are finished by the last run' % (len(finished), phase))
+            tasks = self._recorded_tasks(phase, task_func, tasks, finished)
+            task_func = _run_recorded_task
+        if self.profile:
+            tasks = self._profiled_tasks(phase, task_func, tasks)
+            task_func = _run_profiled_task
+        results = self._run_tasks(phase, task_func, tasks, process_num)
+        if results is not None:
+            results.update(finished)
+            self.report.finish_phase(phase, stopwatch, results.values())
+            if self.profile:
+                self._merge_profiles(phase)
+        return results
+
+    def _recorded_tasks(self, phase, task_func, tasks, finished):
+        for task in tasks:
+            if task['task_id'] not in finished:
+                self._clean_commits(task)
+                yield dict(task, recorded_func=task_func, manifest=self.manifest, phase=phase)
+
+    def _clean_commits(self, task):
+        '''
+        Removes the files committed by a task of the last run which died
+        before the task was recorded, so that its new attempts can commit.
+        '''
+        for conf in (task['collector_conf'], task.get('hot_conf')):
+            if conf is None or not os.path.isdir(conf['path']):
+                continue
+            for name in os.listdir(conf['path']):
+                if name.startswith(conf['prefix'] + '_'):
+                    os.remove(os.path.join(conf['path'], name))
+
+    def _fingerprint(self):
+        '''
+        Returns the fingerprint of the inputs and the options of the job,
+        a job is resumed only if it is unchanged.
+        '''
+        inputs = []
+        for input_dir in self.input_dirs:
+            paths = [input_dir]
+            if os.path.isdir(input_dir):
+                paths = [os.path.join(input_dir, name) for name in sorted(os.listdir(input_dir))]
+            for path in paths:
+                stat = os.stat(path)
+                inputs.append((path, stat.st_size, stat.st_mtime))
+        return fingerprint(inputs, self.splitter_class, self.mapper_class, self.combiner_class, self.reducer_class,
+                self.partitioner, self.reducer_num, self.map_task_num, self.codec, self.compression,
+                self.output_codec, self.total_order, self.sample_num, self.skew, self.skew_threshold)
+
+    def _profile_dir(self, phase):
+        profile_dir = os.path.join(self.work_dir, PROFILE_DIR_NAME, phase)
+        if not os.path.exists(profile_dir):
+            os.makedirs(profile_dir)
+        return profile_dir
+
+    def _profiled_tasks(self, phase, task_func, tasks):
+        profile_dir = self._profile_dir(phase)
+        for task in tasks:
+            yield dict(task, task_func=task_func, profile_path=profile_dir)
+
+    def _merge_profiles(self, phase):
+        profile_dir = self._profile_dir(phase)
+        profile_paths = [os.path.join(profile_dir, name) for name in sorted(os.listdir(profile_dir))]
+        if not profile_paths:
+            return
+        stats = merge_profiles(profile_paths, os.path.join(self.output_path, '_profile_%s.prof' % phase))
+        user_files = [inspect.getsourcefile(cls) for cls in (self.mapper_class, self.reducer_class, self.combiner_class) \
+                if cls is not None]
+        self.report.add_profile(phase, stage_times(stats, user_files))
+
+    def _write_report(self):
+        report_path = self.report_path or os.path.join(self.output_path, REPORT_NAME)
+        try:
+            self.report.write(report_path)
+        except (IOError, OSError):
+            logging.error('failed to write the report to %s: %s' % (report_path, traceback.format_exc()))
+
     def run(self):
         if not self._check_env():
             logging.error('Job canceled since environment checking failed')
             return False
 
-        return True                
+        self.report = JobReport()
+        self.report.succeeded = False
+        self.metrics_server = None
+        if self.metrics_port is not None:
+            self.metrics_server = MetricsServer(self.report, port=self.metrics_port)
+            self.metrics_server.start()
+            logging.info('the metrics are served on %s' % format_address(self.metrics_server.address))
+
+        try:
+            self.report.succeeded = self._run()
+        finally:
+            if self.metrics_server is not None:
+                self.metrics_server.stop()
+            self._write_report()
+        return self.report.succeeded
+
+    def is_complete(self):
+        '''
+        Tells whether the outputs of the job are complete. The _SUCCESS
+        marker is written to the output path once all the phases of a
+        run are committed, and removed when the job is run again, so the
+        outputs of a failed or running job are never taken as complete.
+        '''
+        return os.path.exists(os.path.join(self.output_path, SUCCESS_NAME))
+
+    def _run(self):
+        success_path = os.path.join(self.output_path, SUCCESS_NAME)
+        if os.path.exists(success_path):
+            os.remove(success_path)
+        self.work_dir = os.path.join(self.output_path, WORK_DIR_NAME)
+        self.attempt_dir = os.path.join(self.work_dir, ATTEMPT_DIR_NAME)
+        self.manifest = None
+        split_paths = None
+        if self.resume:
+            self.manifest = JobManifest(os.path.join(self.work_dir, MANIFEST_DIR_NAME))
+            split_paths = self.manifest.load(self._fingerprint())
+            if split_paths is not None:
+                # the attempts of the last run are never committed
+                shutil.rmtree(self.attempt_dir, True)
+        if split_paths is None:
+            self._clean_last_run()
+        if not os.path.exists(self.attempt_dir):
+            os.makedirs(self.attempt_dir)
+        self.segment_dir = None
+        self.map_cache = None
+        if self.map_cache_path is not None:
+            self.map_cache = MapOutputCache(self.map_cache_path, int(self.map_cache_mb * (1 << 20)))
+
+        succeeded = False
+        try:
+            succeeded = self._run_phases(split_paths)
+        finally:
+            if succeeded or self.manifest is None:
+                shutil.rmtree(self.work_dir, True)
+            else:
+                logging.info('the work dir %s is kept to resume the job' % self.work_dir)
+            if self.segment_dir is not None:
+                shutil.rmtree(self.segment_dir, True)
+        if succeeded:
+            open(success_path, 'w').close()
+        return succeeded
+
+    def _clean_last_run(self):
+        '''
+        Removes the work dir and the outputs of the last run into the
+        output path unless they are resumed, since the outputs can not be
+        overwritten by the commits, see _commit_files().
+        '''
+        if not os.path.isdir(self.output_path):
+            return
+        shutil.rmtree(self.work_dir, True)
+        for name in os.listdir(self.output_path):
+            if name.startswith('part_'):
+                os.remove(os.path.join(self.output_path, name))
+
+    def _run_phases(self, split_paths):
+        if split_paths is None:
+            stopwatch = self.report.start_phase('split')
+            if self.profile:
+                profiler = cProfile.Profile()
+                split_paths = profiler.runcall(self._split)
+                profiler.dump_stats(os.path.join(self._profile_dir('split'), 'split.prof'))
+            else:
+                split_paths = self._split()
+            if split_paths is None:
+                return False
+            self.report.finish_phase('split', stopwatch, [])
+            if self.profile:
+                self._merge_profiles('split')
+            if self.manifest is not None:
+                self.manifest.start(split_paths)
+        else:
+            logging.info('the %d splits of the last run are reused' % len(split_paths))
+
+        partitioner = self.partitioner
+        if self.total_order or self.skew:
+            partitioner = self._sample_partitioner(split_paths)
+            if partitioner is None:
+                return False
+
+        self.hot_keys = {}
+        self.home_partitioner = None
+        if isinstance(partitioner, SaltingPartitioner):
+            self.hot_keys = partitioner.hot_keys
+            self.home_partitioner = partitioner.partitioner
+            if not os.path.exists(self._hot_dir()):
+                os.makedirs(self._hot_dir())
+
+        if self.shuffle == 'socket':
+            self._start_shuffle_servers()
+        elif self.shuffle == 'memory':
+            self._start_segment_queues()
+        try:
+            if self._run_phase('map', _run_map_task,
+                    self._map_tasks(split_paths, partitioner), self.mapper_num) is None:
+                return False
+        finally:
+            if self.shuffle == 'socket':
+                self._stop_shuffle_servers()
+            elif self.shuffle == 'memory':
+                self._stop_segment_queues()
+
+        if self.map_cache is not None:
+            logging.info('%d cached map outputs are evicted' % self.map_cache.evict())
+
+        # all the map outputs are ready since the map phase is a barrier
+        if self._run_phase('reduce', _run_reduce_task,
+                self._reduce_tasks(), self.reducer_num) is None:
+            return False
+
+        if self.hot_keys and self._run_phase('merge', _run_reduce_task,
+                self._merge_tasks(), self.reducer_num) is None:
+            return False
+
+        return True
@@ -0,0 +1,105 @@
+import os
+import json
+import logging
+import tempfile
+
+MANIFEST_NAME = 'manifest.json'
+TASKS_DIR_NAME = 'tasks'
+
+def write_json(path, obj):
+    '''
+    Writes obj as json to a temporary file renamed to path, so the file
+    at path is either the old one or the complete new one.
+    '''
+    dir_path = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(prefix='.%s.' % os.path.basename(path), dir=dir_path)
+    try:
+        with os.fdopen(fd, 'w') as tmp_file:
+            json.dump(obj, tmp_file, sort_keys=True)
+        os.rename(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+class JobManifest(object):
+    '''
+    The JobManifest records the progress of a job in a dir of its work
+    dir, so that the job restarted after a failure skips the finished
+    work. The manifest.json holds the fingerprint of the inputs and the
+    options of the job, and the paths of the splits, it is written once
+    the inputs are split. The report of each finished task is written to
+    tasks/<phase>_<task_id>.json by the task itself after its outputs are
+    committed, so it is recorded even if the job process dies, and also
+    by the workers of a cluster sharing the work dir.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.tasks_path = os.path.join(path, TASKS_DIR_NAME)
+        self.fingerprint = None
+
+    def load(self, fingerprint):
+        '''
+        Returns the split paths recorded by a previous run of the same
+        job, or None if there is none or the job has changed. The
+        fingerprint is recorded by start() if the job is not resumed.
+        '''
+        self.fingerprint = fingerprint
+        try:
+            with open(os.path.join(self.path, MANIFEST_NAME)) as manifest_file:
+                manifest = json.load(manifest_file)
+        except (IOError, ValueError):
+            return None
+        if manifest.get('fingerprint') != fingerprint:
+            logging.info('the inputs or the options of the job have changed since the last run')
+            return None
+        split_paths = manifest['split_paths']
+        if not all(os.path.exists(split_path) for split_path in split_paths):
+            return None
+        return split_paths
+
+    def start(self, split_paths):
+        if not os.path.exists(self.tasks_path):
+            os.makedirs(self.tasks_path)
+        write_json(os.path.join(self.path, MANIFEST_NAME),
+                {'fingerprint': self.fingerprint, 'split_paths': split_paths})
+
+    def _task_path(self, phase, task_id):
+        return os.path.join(self.tasks_path, '%s_%d.json' % (phase, task_id))
+
+    def finish_task(self, phase, task_id, report):
+        write_json(self._task_path(phase, task_id), report)
+
+    def finished_tasks(self, phase):
+        '''
+        Returns the reports of the finished tasks of a phase by task id.
+        '''
+        reports = {}
+        if not os.path.isdir(self.tasks_path):
+            return reports
+        for name in os.listdir(self.tasks_path):
+            task_phase, sep, task_id = os.path.splitext(name)[0].rpartition('_')
+            if task_phase != phase or name.startswith('.') or not task_id.isdigit():
+                continue
+            with open(os.path.join(self.tasks_path, name)) as report_file:
+                reports[int(task_id)] = json.load(report_file)
+        return reports
+
+def test():
+    import shutil
+    path = tempfile.mkdtemp()
+    try:
+        manifest = JobManifest(os.path.join(path, '_manifest'))
+        split_path = os.path.join(path, 'split_0')
+        open(split_path, 'w').close()
+        print 'nothing to resume: %s' % (manifest.load('abc') is None)
+        manifest.start([split_path])
+        manifest.finish_task('map', 0, {'counters': {}})
+        manifest.finish_task('reduce', 1, {'counters': {}})
+        print 'resumed splits: %s' % (manifest.load('abc') == [split_path])
+        print 'changed job: %s' % (manifest.load('abd') is None)
+        print 'finished map tasks: %s, expected: [0]' % manifest.finished_tasks('map').keys()
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == '__main__':
+    test()
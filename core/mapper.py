@@ -1,7 +1,15 @@
 import logging
 import inspect
+import itertools
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from collector import BaseCollector, DebugCollector
+from counters import FRAMEWORK_GROUP
+
+DEFAULT_BATCH_SIZE = 4096
 
 class MapConfigureError(Exception):
     def __init__(self, msg):
@@ -42,12 +50,84 @@ class BaseMapper(object):
     def set_inputs(self, inputs):
         self.inputs = inputs
 
+    def incr_counter(self, group, name, amount=1):
+        '''
+        Increments a counter, the counters of all the tasks are added up
+        in the report of the job.
+        '''
+        self.collector.counters.incr(group, name, amount)
+
     def run(self):
         if not self._check_env():
             raise MapConfigureError('The mapper environment is invalid.')
 
+        records = 0
         for key, value in self.inputs:
             self.map(key, value, self.collector)
+            records += 1
+        self.collector.counters.incr(FRAMEWORK_GROUP, 'input_records', records)
+
+def to_columns(kvs, to_arrays=False):
+    '''
+    Turns a list of k/v pairs into the columns of the keys and the
+    values, which are numpy arrays if to_arrays is True.
+    '''
+    keys = [k for k, v in kvs]
+    values = [v for k, v in kvs]
+    if to_arrays:
+        return numpy.asarray(keys), numpy.asarray(values)
+    return keys, values
+
+class BatchMapper(BaseMapper):
+    '''
+    The BatchMapper maps the inputs a batch at a time instead of one by
+    one, so that the per-call overhead is paid once per batch_size
+    inputs and the map can be vectorized. Subclasses implement
+    map_batch(keys, values, collector), the keys and the values are the
+    columns of the batch, which are lists, or numpy arrays if to_arrays
+    is True, and the outputs should be collected at once by
+    collector.collect_batch(keys, values).
+    '''
+    batch_size = DEFAULT_BATCH_SIZE
+    to_arrays = False
+
+    def _check_env(self):
+        if self.to_arrays and numpy is None:
+            logging.error('The numpy module is not available for %s' % self.__class__.__name__)
+            return False
+
+        map_signature = inspect.getargspec(self.map_batch)
+        if len(map_signature.args) != 4:
+            logging.error('The number of parameters[%d] of map_batch is invalid' % \
+                    len(map_signature.args))
+            return False
+
+        return BaseMapper._check_env(self)
+
+    def set_batch_size(self, batch_size):
+        self.batch_size = batch_size
+
+    def map(self, key, value, collector):
+        keys, values = to_columns([(key, value)], self.to_arrays)
+        self.map_batch(keys, values, collector)
+
+    def map_batch(self, keys, values, collector):
+        raise NotImplementedError()
+
+    def run(self):
+        if not self._check_env():
+            raise MapConfigureError('The mapper environment is invalid.')
+
+        records = 0
+        inputs = iter(self.inputs)
+        while True:
+            kvs = list(itertools.islice(inputs, self.batch_size))
+            if not kvs:
+                break
+            keys, values = to_columns(kvs, self.to_arrays)
+            self.map_batch(keys, values, self.collector)
+            records += len(kvs)
+        self.collector.counters.incr(FRAMEWORK_GROUP, 'input_records', records)
 
 class MapperTemplate(BaseMapper):
     def __init__(self, map_func, collector):
@@ -84,5 +164,16 @@ def test():
     print 'expected: %s\t%s' % inputs[0]
     bm.run()
 
+    class MyBatchMapper(BatchMapper):
+        def map_batch(self, keys, values, collector):
+            collector.collect_batch(keys, values)
+
+    print 'test subclass of BatchMapper ......'
+    bm = MyBatchMapper(dc)
+    bm.set_batch_size(2)
+    bm.set_inputs(inputs * 3)
+    print 'expected: %s' % ', '.join(['%s\t%s' % inputs[0]] * 3)
+    bm.run()
+
 if __name__ == '__main__':
     test()
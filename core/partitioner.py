@@ -0,0 +1,116 @@
+import zlib
+import bisect
+
+PARTITIONER = 'partitioner'
+
+class PartitionerConfigureError(Exception):
+    def __init__(self, msg):
+        self.value = msg
+
+    def __str__(self):
+        return repr(self.value)
+
+def key_bytes(key):
+    '''
+    Returns a byte string of the key which is the same in every process,
+    the keys which are equal, e.g. u'a' and 'a', 1 and 1L or True and 1,
+    have the same byte string.
+    '''
+    key_type = type(key)
+    if key_type is str:
+        return key
+    elif key_type is unicode:
+        return key.encode('utf-8')
+    elif key_type is tuple or key_type is list:
+        return '\x00'.join(key_bytes(k) for k in key)
+    elif key_type is float and key.is_integer() or key_type is bool:
+        return str(int(key))
+    elif key_type is float:
+        return repr(key)
+    elif key is None:
+        return ''
+    return str(key)
+
+class BasePartitioner(object):
+    '''
+    A partitioner decides the slice of the collector which a key is
+    sent to, the same key must be sent to the same slice by all the
+    mappers, even if they are run in different processes or machines.
+    '''
+    def partition(self, key, slice_num):
+        raise NotImplementedError()
+
+class HashPartitioner(BasePartitioner):
+    '''
+    The HashPartitioner sends a key to the slice of the crc32 of the key
+    modulo slice_num. Unlike the builtin hash(), crc32 is not randomized
+    per process.
+    '''
+    def partition(self, key, slice_num):
+        return (zlib.crc32(key_bytes(key)) & 0xffffffff) % slice_num
+
+class RangePartitioner(BasePartitioner):
+    '''
+    The RangePartitioner sends the keys in [split_points[i-1], split_points[i])
+    to the slice i, the split_points are sorted and there should be
+    slice_num - 1 of them. The keys of slice i are less than the keys of
+    slice i + 1, so the outputs of all the slices are in order.
+    '''
+    def __init__(self, split_points):
+        self.split_points = sorted(split_points)
+
+    @classmethod
+    def from_samples(cls, keys, slice_num):
+        '''
+        Creates a RangePartitioner whose split points divide the sampled
+        keys into slice_num slices of the same size.
+        '''
+        keys = sorted(keys)
+        if not keys:
+            return cls([])
+        return cls([keys[len(keys) * i / slice_num] for i in range(1, slice_num)])
+
+    def partition(self, key, slice_num):
+        return min(bisect.bisect_right(self.split_points, key), slice_num - 1)
+
+class SaltingPartitioner(BasePartitioner):
+    '''
+    The SaltingPartitioner spreads the values of each hot key over
+    several slices to balance a skewed key distribution. The hot_keys
+    is a dict of the number of slices of each hot key, the values of a
+    hot key are sent round robin to the slices following the slice given
+    by the partitioner, and the other keys are partitioned as usual.
+    The partial results of the hot keys must be merged at last.
+    '''
+    def __init__(self, partitioner, hot_keys):
+        self.partitioner = get_partitioner(partitioner)
+        self.hot_keys = hot_keys
+        self.salts = {}
+
+    def partition(self, key, slice_num):
+        slice_idx = self.partitioner.partition(key, slice_num)
+        fanout = self.hot_keys.get(key)
+        if not fanout:
+            return slice_idx
+        salt = self.salts.get(key, 0)
+        self.salts[key] = (salt + 1) % fanout
+        return (slice_idx + salt) % slice_num
+
+PARTITIONERS = {
+        'hash': HashPartitioner,
+        }
+
+DEFAULT_PARTITIONER = 'hash'
+
+def get_partitioner(partitioner):
+    '''
+    Returns the partitioner object for a partitioner object or the name
+    of a partitioner.
+    '''
+    if partitioner is None:
+        partitioner = DEFAULT_PARTITIONER
+    if isinstance(partitioner, BasePartitioner):
+        return partitioner
+    if partitioner not in PARTITIONERS:
+        raise PartitionerConfigureError('Unknown partitioner %s' % str(partitioner))
+    return PARTITIONERS[partitioner]()
@@ -0,0 +1,125 @@
+import sys
+import time
+import logging
+import traceback
+import collections
+import multiprocessing
+
+from splitter import KVFileSplitter
+
+# the seconds between the checks of the running jobs
+POLL_INTERVAL = 0.1
+
+class PipelineError(Exception):
+    def __init__(self, msg):
+        self.value = msg
+
+    def __str__(self):
+        return repr(self.value)
+
+class Pipeline(object):
+    '''
+    The Pipeline runs a DAG of jobs, e.g. a word count followed by a top-N.
+    A job added with upstream jobs reads their outputs directly: each
+    output file of their reducers is handed as a whole to its mappers by
+    the KVFileSplitter, so the k/v pairs are neither re-split nor parsed
+    from lines. For that the reducers of an upstream job write with the
+    codec of the job reading them instead of the output_codec, i.e. the
+    binary codec by default.
+
+    The jobs are added after they are configured, and after their upstream
+    jobs, so the jobs can not form a cycle. Each job runs in a child
+    process once all its upstream jobs succeeded, so the independent
+    branches run at the same time. The processes are forked by the thread
+    calling run(), which should be the main thread: the pools of workers
+    of a job must not be forked from a process running other threads.
+    Since the jobs run in their own processes, the Job objects of the
+    pipeline are not updated by their runs, e.g. their reports. A job
+    only succeeds if its outputs are marked complete, see
+    Job.is_complete(), so its downstream jobs never read partial outputs.
+    '''
+    def __init__(self):
+        self.jobs = collections.OrderedDict()
+        self.upstreams = {}
+        self.results = {}
+
+    def add_job(self, name, job, upstreams=()):
+        '''
+        Adds a job named name which reads the outputs of the upstream jobs
+        by their names. A job with upstream jobs can not have its own input
+        dirs, since all its inputs are read by the KVFileSplitter.
+        '''
+        if name in self.jobs:
+            raise PipelineError('The job %s is added already' % name)
+        for upstream in upstreams:
+            if upstream not in self.jobs:
+                raise PipelineError('The upstream job %s of %s is not added' % (upstream, name))
+            if not self.jobs[upstream].output_path:
+                raise PipelineError('The upstream job %s of %s has no output path' % (upstream, name))
+        if upstreams:
+            if job.input_dirs:
+                raise PipelineError('The job %s reads its upstream jobs, it can not have any input dir' % name)
+            for upstream in upstreams:
+                upstream_job = self.jobs[upstream]
+                if self._downstreams(upstream) and upstream_job.output_codec != job.codec:
+                    raise PipelineError('The jobs reading %s must have the same codec' % upstream)
+                upstream_job.set_output_codec(job.codec)
+                job.add_input_dir(upstream_job.output_path)
+            job.set_splitter(KVFileSplitter)
+        self.jobs[name] = job
+        self.upstreams[name] = list(upstreams)
+
+    def _downstreams(self, name):
+        return [downstream for downstream, upstreams in self.upstreams.iteritems() if name in upstreams]
+
+    def _run_job(self, name):
+        '''
+        Runs a job in the child process, the exit code tells its result.
+        '''
+        try:
+            succeeded = self.jobs[name].run()
+        except:
+            logging.error('the job %s failed: %s' % (name, traceback.format_exc()))
+            succeeded = False
+        sys.exit(0 if succeeded else 1)
+
+    def _start_job(self, name):
+        logging.info('the job %s starts' % name)
+        # not a daemon, since a job starts its own processes
+        process = multiprocessing.Process(target=self._run_job, args=(name,))
+        process.start()
+        return process
+
+    def run(self):
+        '''
+        Runs the jobs and returns True if all of them succeeded. The result
+        of each job is kept in results by name, it is None if the job was
+        not run since an upstream job failed.
+        '''
+        self.results = dict((name, None) for name in self.jobs)
+        pending = list(self.jobs)
+        blocked = set()
+        running = {}
+        while True:
+            for name in list(pending):
+                upstreams = self.upstreams[name]
+                if any(self.results[upstream] is False or upstream in blocked for upstream in upstreams):
+                    logging.error('the job %s is not run since its upstream jobs failed' % name)
+                    blocked.add(name)
+                    pending.remove(name)
+                elif all(self.results[upstream] for upstream in upstreams):
+                    running[name] = self._start_job(name)
+                    pending.remove(name)
+            if not running:
+                break
+            finished = [name for name, process in running.iteritems() if not process.is_alive()]
+            if not finished:
+                time.sleep(POLL_INTERVAL)
+                continue
+            for name in finished:
+                process = running.pop(name)
+                process.join()
+                succeeded = process.exitcode == 0 and self.jobs[name].is_complete()
+                self.results[name] = succeeded
+                logging.info('the job %s %s' % (name, 'succeeded' if succeeded else 'failed'))
+        return all(self.results.itervalues())
@@ -0,0 +1,112 @@
+import os
+import inspect
+import pstats
+
+import sorter
+
+STAGES = ('split', 'read', 'map', 'collect', 'sort', 'merge', 'reduce', 'other')
+
+FRAMEWORK_PATH = os.path.dirname(os.path.abspath(__file__))
+
+# the stages of the framework modules, the functions of the other
+# modules, e.g. json or the builtins, are charged to their callers
+MODULE_STAGES = {
+        'splitter': 'split',
+        'compressed': 'read',
+        'mapper': 'map',
+        'collector': 'collect',
+        'partitioner': 'collect',
+        'shuffle': 'collect',
+        'shm': 'collect',
+        'codec': 'collect',
+        'sorter': 'merge',
+        'reducer': 'reduce',
+        'job': 'other',
+        'cluster': 'other',
+        'counters': 'other',
+        'sketch': 'other',
+        'cache': 'other',
+        'manifest': 'other',
+        }
+
+# the functions reading and decoding the inputs of a task
+READ_FUNCTIONS = frozenset(['read', 'read_file', '_read_block', 'decode_block', 'loads', 'read_index',
+    'read_block', 'read_segment', 'read_split', 'read_range', 'read_kv_file'])
+
+USER_STAGES = {
+        'map': 'map',
+        'map_batch': 'map',
+        'reduce': 'reduce',
+        'reduce_batch': 'reduce',
+        }
+
+class StageClassifier(object):
+    '''
+    The StageClassifier tells the stage of the framework which each
+    function of a profile belongs to. The functions of the framework
+    are classified by their modules, the map and reduce methods in the
+    user_files by their names, and any other function by the stage of
+    the caller which spent the most time in it.
+    '''
+    def __init__(self, stats, user_files):
+        self.stats = stats
+        self.user_files = set(os.path.abspath(path) for path in user_files)
+        lines, start = inspect.getsourcelines(sorter.HeapSorter)
+        self.heap_lines = (start, start + len(lines))
+        self.stages = {}
+
+    def _own_stage(self, func):
+        path, line, name = func
+        if os.path.abspath(path) in self.user_files:
+            return USER_STAGES.get(name)
+        if os.path.dirname(os.path.abspath(path)) != FRAMEWORK_PATH:
+            return None
+        module = os.path.splitext(os.path.basename(path))[0]
+        if name in READ_FUNCTIONS and module != 'sorter':
+            return 'read'
+        if module == 'sorter' and self.heap_lines[0] <= line < self.heap_lines[1]:
+            return 'sort'
+        return MODULE_STAGES.get(module, 'other')
+
+    def stage(self, func, visiting=None):
+        if func in self.stages:
+            return self.stages[func]
+        stage = self._own_stage(func)
+        if stage is None:
+            visiting = visiting or set()
+            visiting.add(func)
+            callers = self.stats.stats.get(func, (0, 0, 0, 0, {}))[4]
+            callers = [(caller_stats[3], caller) for caller, caller_stats in callers.iteritems() \
+                    if caller not in visiting]
+            stage = self.stage(max(callers)[1], visiting) if callers else 'other'
+        self.stages[func] = stage
+        return stage
+
+def stage_times(stats, user_files):
+    '''
+    Returns the seconds spent in each stage by a pstats.Stats. The own
+    time of a function which does not belong to a stage, e.g. a builtin,
+    is split among its callers by the time spent from each of them.
+    '''
+    classifier = StageClassifier(stats, user_files)
+    times = dict((stage, 0.0) for stage in STAGES)
+    for func, (cc, nc, tt, ct, callers) in stats.stats.iteritems():
+        if classifier._own_stage(func) is not None or not callers:
+            times[classifier.stage(func)] += tt
+            continue
+        callers_tt = sum(caller_stats[2] for caller_stats in callers.itervalues())
+        if callers_tt <= 0:
+            times[classifier.stage(func)] += tt
+            continue
+        for caller, caller_stats in callers.iteritems():
+            times[classifier.stage(caller)] += tt * caller_stats[2] / callers_tt
+    return times
+
+def merge_profiles(profile_paths, merged_path):
+    '''
+    Merges the profiles dumped by the tasks, and dumps the merged
+    profile to the merged_path, which can be loaded by pstats.
+    '''
+    stats = pstats.Stats(*profile_paths)
+    stats.dump_stats(merged_path)
+    return stats
@@ -1,7 +1,15 @@
 import logging
 import inspect
+import itertools
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from collector import BaseCollector, DebugCollector
+from mapper import DEFAULT_BATCH_SIZE
+from sorter import ValuesIterator
+from counters import FRAMEWORK_GROUP
 
 class ReduceConfigureError(Exception):
     def __init__(self, msg):
@@ -11,6 +19,9 @@ class ReduceConfigureError(Exception):
         return repr(self.value)
 
 class BaseReducer(object):
+    hot_keys = frozenset()
+    hot_collector = None
+
     def __init__(self, collector):
         self.collector = collector
 
@@ -41,13 +52,122 @@ class BaseReducer(object):
 
     def set_input_dicts(self, input_dicts):
         self.input_dicts = input_dicts
+        self.inputs = input_dicts.items()
+
+    def set_inputs(self, inputs):
+        '''
+        The inputs is an iterable of (key, values) grouped by key,
+        e.g. the groups of a ConcurrentMergeSorter, so that the
+        whole partition need not to be loaded into memory. The values
+        of each key are given to reduce() as an iterable which can only
+        be consumed once, unless len(values) is called first, which loads
+        the values into a list so they can be iterated again, see
+        ValuesIterator. The values must be consumed or loaded before
+        reduce() returns, since the next group is read after them.
+        '''
+        self.inputs = inputs
+
+    def set_hot_keys(self, hot_keys, hot_collector):
+        '''
+        The values of the hot keys are spread over several reducers, so
+        each reducer only gets a part of them. The outputs of the hot
+        keys are collected by the hot_collector instead, and they are
+        reduced again in the final merge pass of the job.
+        '''
+        self.hot_keys = hot_keys
+        self.hot_collector = hot_collector
+
+    def incr_counter(self, group, name, amount=1):
+        '''
+        Increments a counter, the counters of all the tasks are added up
+        in the report of the job.
+        '''
+        self.collector.counters.incr(group, name, amount)
 
     def run(self):
         if not self._check_env():
             raise ReduceConfigureError('The reducer environment is invalid.')
 
-        for key, values in self.input_dicts.items():
-            self.reduce(key, values, self.collector)
+        groups = 0
+        for key, values in self.inputs:
+            groups += 1
+            if type(values) is not list and type(values) is not ValuesIterator:
+                # the values are streamed, see ValuesIterator
+                values = ValuesIterator(values)
+            if self.hot_keys and key in self.hot_keys:
+                self.reduce(key, values, self.hot_collector)
+            else:
+                self.reduce(key, values, self.collector)
+        self.collector.counters.incr(FRAMEWORK_GROUP, 'input_groups', groups)
+
+class BatchReducer(BaseReducer):
+    '''
+    The BatchReducer reduces the groups a batch at a time instead of one
+    by one. Subclasses implement reduce_batch(keys, values, collector),
+    the keys are the keys of batch_size groups, and values[i] is the
+    list of the values of keys[i]. The keys and each list of values are
+    numpy arrays if to_arrays is True. The outputs should be collected
+    at once by collector.collect_batch(keys, values).
+    '''
+    batch_size = DEFAULT_BATCH_SIZE
+    to_arrays = False
+
+    def _check_env(self):
+        if self.to_arrays and numpy is None:
+            logging.error('The numpy module is not available for %s' % self.__class__.__name__)
+            return False
+
+        reduce_signature = inspect.getargspec(self.reduce_batch)
+        if len(reduce_signature.args) != 4:
+            logging.error('The number of parameters[%d] of reduce_batch is invalid' % \
+                    len(reduce_signature.args))
+            return False
+
+        return BaseReducer._check_env(self)
+
+    def set_batch_size(self, batch_size):
+        self.batch_size = batch_size
+
+    def _values(self, values):
+        if self.to_arrays:
+            return numpy.asarray(list(values))
+        return list(values)
+
+    def _keys(self, keys):
+        if self.to_arrays:
+            return numpy.asarray(keys)
+        return keys
+
+    def reduce(self, key, values, collector):
+        self.reduce_batch(self._keys([key]), [self._values(values)], collector)
+
+    def reduce_batch(self, keys, values, collector):
+        raise NotImplementedError()
+
+    def run(self):
+        if not self._check_env():
+            raise ReduceConfigureError('The reducer environment is invalid.')
+
+        groups_num = 0
+        inputs = iter(self.inputs)
+        while True:
+            # the values of each group are loaded before the next group is taken
+            groups = [(key, self._values(values)) for key, values in itertools.islice(inputs, self.batch_size)]
+            if not groups:
+                break
+            groups_num += len(groups)
+            if self.hot_keys:
+                hot_groups = [(key, values) for key, values in groups if key in self.hot_keys]
+                groups = [(key, values) for key, values in groups if key not in self.hot_keys]
+                if hot_groups:
+                    self._reduce_groups(hot_groups, self.hot_collector)
+            if groups:
+                self._reduce_groups(groups, self.collector)
+        self.collector.counters.incr(FRAMEWORK_GROUP, 'input_groups', groups_num)
+
+    def _reduce_groups(self, groups, collector):
+        self.reduce_batch(self._keys([key for key, values in groups]),
+                [values for key, values in groups], collector)
 
 class ReducerTemplate(BaseReducer):
     def __init__(self, reduce_func, collector):
@@ -86,5 +206,15 @@ def test():
     print 'expected: %s' % ''.join(('%s\t%s' % (key, str(values)) for key, values in inputs.items()))
     bm.run()
 
+    class MyBatchReducer(BatchReducer):
+        def reduce_batch(self, keys, values, collector):
+            collector.collect_batch(keys, [len(key_values) for key_values in values])
+
+    print 'test subclass of BatchReducer ......'
+    bm = MyBatchReducer(dc)
+    bm.set_input_dicts(inputs)
+    print 'expected: %s' % ''.join(('%s\t%d' % (key, len(values)) for key, values in inputs.items()))
+    bm.run()
+
 if __name__ == '__main__':
     test()
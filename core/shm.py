@@ -0,0 +1,122 @@
+import os
+import mmap
+import Queue
+import tempfile
+
+from codec import BLOCK_HEADER, FLAG_INDEX, BinaryCodec, CodecError, get_codec
+
+SHM_PATH = '/dev/shm'
+
+def shm_path():
+    '''
+    Returns the dir of the shared memory filesystem, or the temp dir
+    if there is no writable /dev/shm.
+    '''
+    if os.path.isdir(SHM_PATH) and os.access(SHM_PATH, os.W_OK):
+        return SHM_PATH
+    return tempfile.gettempdir()
+
+class SegmentStream(object):
+    '''
+    The SegmentStream is a writable file-like object writing a segment
+    file of the given name under the path, which should be on a shared
+    memory filesystem, so that the data is written into memory pages
+    shared with the readers instead of to disk.
+
+    When the stream is closed, the descriptor (path, length) of the
+    segment is put into the queue, e.g. a queue of a multiprocessing
+    Manager, which is drained by the reader of the segments.
+    '''
+    def __init__(self, path, name, queue):
+        self.path = os.path.join(path, name)
+        self.queue = queue
+        self.stream = open(self.path, 'wb')
+        self.length = 0
+
+    def write(self, data):
+        self.stream.write(data)
+        self.length += len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.stream.close()
+        self.queue.put((self.path, self.length))
+
+def drain_segments(queue):
+    '''
+    Returns the descriptors of all the segments in the queue.
+    '''
+    descriptors = []
+    while True:
+        try:
+            descriptors.append(queue.get_nowait())
+        except Queue.Empty:
+            return descriptors
+
+def read_segment(path, codec=None):
+    '''
+    Reads back the k/v pairs of a segment written with the codec. The
+    segment is mapped into memory and the blocks of a BinaryCodec are
+    decoded from buffers of the mapping, so the data is not copied
+    before it is unmarshaled. Other codecs read the segment as a file.
+    '''
+    codec = get_codec(codec)
+    if not isinstance(codec, BinaryCodec):
+        for k, v in codec.read_file(path):
+            yield k, v
+        return
+
+    with open(path, 'rb') as stream:
+        if os.fstat(stream.fileno()).st_size == 0:
+            return
+        segment = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        offset = 0
+        while offset + BLOCK_HEADER.size <= len(segment):
+            flags, length, checksum = BLOCK_HEADER.unpack_from(segment, offset)
+            offset += BLOCK_HEADER.size
+            # the index block is the last block of a segment
+            if flags & FLAG_INDEX:
+                return
+            if offset + length > len(segment):
+                raise CodecError('The block of the segment %s is truncated' % path)
+            records = codec.decode_block(flags, buffer(segment, offset, length), checksum)
+            offset += length
+            for k, v in records:
+                yield k, v
+    finally:
+        segment.close()
+
+def test():
+    import shutil
+    import multiprocessing
+
+    def write(path, queue, task_id):
+        codec = get_codec(None, block_records=10, compression='zlib')
+        writer = codec.writer(SegmentStream(path, 'map_%d' % task_id, queue))
+        for i in range(100):
+            writer.write('key_%d_%d' % (task_id, i), i)
+        writer.close()
+
+    path = tempfile.mkdtemp(dir=shm_path())
+    manager = multiprocessing.Manager()
+    try:
+        queue = manager.Queue()
+        writers = [multiprocessing.Process(target=write, args=(path, queue, i)) for i in range(3)]
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join()
+
+        for segment_path, length in sorted(drain_segments(queue)):
+            records = list(read_segment(segment_path))
+            print '%s: %d bytes, %d records, expected: 100' % \
+                    (os.path.basename(segment_path), length, len(records))
+    finally:
+        manager.shutdown()
+        shutil.rmtree(path)
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,227 @@
+import os
+import socket
+import struct
+import logging
+import threading
+import traceback
+
+# the header of each frame: type, length of the payload, length of the stream name
+FRAME_HEADER = struct.Struct('<BIH')
+FRAME_DATA = 1
+FRAME_CLOSE = 2
+FRAME_STOP = 3
+
+ACK = '\x01'
+
+DEFAULT_WINDOW = 16
+
+class ShuffleError(Exception):
+    def __init__(self, msg):
+        self.value = msg
+
+    def __str__(self):
+        return repr(self.value)
+
+def parse_address(address):
+    '''
+    Parses an address of host:port into a (host, port) tuple.
+    '''
+    if type(address) is tuple:
+        return address
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+def format_address(address):
+    return '%s:%d' % address
+
+class ShuffleServer(object):
+    '''
+    The ShuffleServer receives the outputs of the mappers for one
+    reducer. The senders push named streams of blocks over persistent
+    connections, each stream is written to a file of its name under the
+    path, and the file is renamed from a temporary name when the stream
+    is closed, so the reducer only sees complete streams.
+
+    Every frame is acknowledged after it is written, a sender waits for
+    the acknowledgements once it has window frames in flight, which
+    throttles the mappers if the reducer side falls behind.
+
+    The socket is bound when the server is created, so that the address
+    is known before serve_forever() is called in another process.
+    '''
+    def __init__(self, path, host='127.0.0.1', port=0):
+        self.path = path
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(128)
+        self.address = self.sock.getsockname()
+        self.stopped = threading.Event()
+
+    def _handle(self, conn):
+        rfile = conn.makefile('rb', 64 * 1024)
+        writers = {}
+        try:
+            while True:
+                header = rfile.read(FRAME_HEADER.size)
+                if len(header) < FRAME_HEADER.size:
+                    break
+                frame_type, length, name_length = FRAME_HEADER.unpack(header)
+                name = rfile.read(name_length)
+                payload = rfile.read(length)
+                if len(name) < name_length or len(payload) < length:
+                    raise ShuffleError('The frame of %s is truncated' % name)
+
+                if frame_type == FRAME_DATA:
+                    if name not in writers:
+                        writers[name] = open(os.path.join(self.path, '.%s.tmp' % name), 'wb')
+                    writers[name].write(payload)
+                elif frame_type == FRAME_CLOSE:
+                    if name not in writers:
+                        writers[name] = open(os.path.join(self.path, '.%s.tmp' % name), 'wb')
+                    writers.pop(name).close()
+                    os.rename(os.path.join(self.path, '.%s.tmp' % name), os.path.join(self.path, name))
+                elif frame_type == FRAME_STOP:
+                    self.stopped.set()
+                    break
+                conn.sendall(ACK)
+        except:
+            logging.error('The shuffle connection failed: %s' % traceback.format_exc())
+        finally:
+            for writer in writers.values():
+                writer.close()
+            rfile.close()
+            conn.close()
+
+    def serve_forever(self):
+        self.sock.settimeout(0.2)
+        while not self.stopped.is_set():
+            try:
+                conn, address = self.sock.accept()
+            except socket.timeout:
+                continue
+            conn.settimeout(None)
+            thread = threading.Thread(target=self._handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+        self.sock.close()
+
+    def close(self):
+        self.sock.close()
+
+class ShuffleClient(object):
+    '''
+    The ShuffleClient keeps a persistent connection to a ShuffleServer,
+    use get_client() to share the connection among the collectors of
+    the same process.
+    '''
+    def __init__(self, address, window=DEFAULT_WINDOW):
+        self.address = parse_address(address)
+        self.window = window
+        self.sock = socket.create_connection(self.address)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.unacked = 0
+
+    def _wait_acks(self, max_unacked):
+        while self.unacked > max_unacked:
+            acks = self.sock.recv(self.unacked)
+            if not acks:
+                raise ShuffleError('The shuffle server %s closed the connection' % format_address(self.address))
+            self.unacked -= len(acks)
+
+    def send(self, frame_type, name, payload=''):
+        self.sock.sendall(FRAME_HEADER.pack(frame_type, len(payload), len(name)) + name + payload)
+        self.unacked += 1
+        self._wait_acks(self.window - 1)
+
+    def flush(self):
+        '''
+        Waits until all the frames sent are written by the server.
+        '''
+        self._wait_acks(0)
+
+    def stop_server(self):
+        self.sock.sendall(FRAME_HEADER.pack(FRAME_STOP, 0, 0))
+        self.sock.close()
+
+    def close(self):
+        self.sock.close()
+
+_clients = {}
+
+def get_client(address):
+    address = parse_address(address)
+    if address not in _clients:
+        _clients[address] = ShuffleClient(address)
+    return _clients[address]
+
+class ShuffleStream(object):
+    '''
+    The ShuffleStream is a writable file-like object sending the data to
+    the stream of the given name on a ShuffleServer, so that any codec
+    writer can write to it.
+    '''
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def write(self, data):
+        self.client.send(FRAME_DATA, self.name, data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.client.send(FRAME_CLOSE, self.name)
+
+def stop_server(address):
+    ShuffleClient(address).stop_server()
+
+def test():
+    import shutil
+    import tempfile
+    import multiprocessing
+    from codec import get_codec
+
+    def send(addresses, task_id):
+        codec = get_codec(None, block_records=10)
+        for address in addresses:
+            writer = codec.writer(ShuffleStream(get_client(address), 'map_%d' % task_id))
+            for i in range(100):
+                writer.write('key_%d_%d' % (task_id, i), i)
+            writer.close()
+            get_client(address).flush()
+
+    tmp_path = tempfile.mkdtemp()
+    try:
+        # each process acts as a node
+        servers = [ShuffleServer(os.path.join(tmp_path, 'reducer_%d' % i)) for i in range(2)]
+        server_processes = [multiprocessing.Process(target=server.serve_forever) for server in servers]
+        for process in server_processes:
+            process.start()
+        addresses = [format_address(server.address) for server in servers]
+        for server in servers:
+            server.close()
+
+        senders = [multiprocessing.Process(target=send, args=(addresses, i)) for i in range(3)]
+        for sender in senders:
+            sender.start()
+        for sender in senders:
+            sender.join()
+
+        for address, process in zip(addresses, server_processes):
+            stop_server(address)
+            process.join()
+
+        codec = get_codec(None)
+        for server in servers:
+            for name in sorted(os.listdir(server.path)):
+                records = list(codec.read_file(os.path.join(server.path, name)))
+                print '%s/%s: %d records, expected: 100' % (os.path.basename(server.path), name, len(records))
+    finally:
+        shutil.rmtree(tmp_path)
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,143 @@
+import zlib
+import array
+
+from partitioner import key_bytes
+
+DEFAULT_WIDTH = 2048
+DEFAULT_DEPTH = 4
+DEFAULT_CAPACITY = 64
+
+class SketchError(Exception):
+    def __init__(self, msg):
+        self.value = msg
+
+    def __str__(self):
+        return repr(self.value)
+
+class CountMinSketch(object):
+    '''
+    The CountMinSketch estimates the count of each key in a fixed
+    table of depth rows of width counters: a key is counted in one
+    counter of each row chosen by a seeded crc32 of the key, and its
+    count is estimated by the minimum of its counters, which is never
+    less than the real count. The sketches of several mappers are
+    merged by adding up the counters.
+    '''
+    def __init__(self, width=DEFAULT_WIDTH, depth=DEFAULT_DEPTH):
+        self.width = width
+        self.depth = depth
+        self.tables = [array.array('L', [0]) * width for i in range(depth)]
+        self.total = 0
+
+    def _cells(self, key):
+        data = key_bytes(key)
+        return [(zlib.crc32(data, seed) & 0xffffffff) % self.width for seed in range(self.depth)]
+
+    def add(self, key, count=1):
+        for table, cell in zip(self.tables, self._cells(key)):
+            table[cell] += count
+        self.total += count
+
+    def estimate(self, key):
+        return min(table[cell] for table, cell in zip(self.tables, self._cells(key)))
+
+    def merge(self, other):
+        if self.width != other.width or self.depth != other.depth:
+            raise SketchError('Can not merge the sketches of different sizes')
+        for table, other_table in zip(self.tables, other.tables):
+            for cell in xrange(self.width):
+                table[cell] += other_table[cell]
+        self.total += other.total
+
+class HeavyHitters(object):
+    '''
+    The HeavyHitters keeps the candidates of the most frequent keys by
+    the Misra-Gries summary of capacity counters: a new key takes a
+    free counter, and if there is none all the counters are decreased,
+    so any key occurring more than total / (capacity + 1) times is kept.
+    The keys must be hashable.
+    '''
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.counters = {}
+
+    def add(self, key, count=1):
+        if key in self.counters or len(self.counters) < self.capacity:
+            self.counters[key] = self.counters.get(key, 0) + count
+            return
+        decrement = min(count, min(self.counters.itervalues()))
+        for k in self.counters.keys():
+            self.counters[k] -= decrement
+            if self.counters[k] <= 0:
+                del self.counters[k]
+        if count > decrement:
+            self.counters[key] = count - decrement
+
+    def merge(self, other):
+        for key, count in other.counters.iteritems():
+            self.counters[key] = self.counters.get(key, 0) + count
+        if len(self.counters) > self.capacity:
+            # keep the capacity largest counters less the next largest one
+            decrement = sorted(self.counters.itervalues(), reverse=True)[self.capacity]
+            for k in self.counters.keys():
+                self.counters[k] -= decrement
+                if self.counters[k] <= 0:
+                    del self.counters[k]
+
+    def candidates(self):
+        return self.counters.keys()
+
+class KeySketch(object):
+    '''
+    The KeySketch counts the keys of the sampled map outputs to find the
+    hot keys, the HeavyHitters gives the candidates and the CountMinSketch
+    estimates their counts.
+    '''
+    def __init__(self, width=DEFAULT_WIDTH, depth=DEFAULT_DEPTH, capacity=DEFAULT_CAPACITY):
+        self.count_min = CountMinSketch(width, depth)
+        self.heavy_hitters = HeavyHitters(capacity)
+
+    def update(self, keys):
+        for key in keys:
+            self.count_min.add(key)
+            self.heavy_hitters.add(key)
+
+    def merge(self, other):
+        self.count_min.merge(other.count_min)
+        self.heavy_hitters.merge(other.heavy_hitters)
+
+    @property
+    def total(self):
+        return self.count_min.total
+
+    def hot_keys(self, min_count):
+        '''
+        Returns a dict of the estimated counts of the keys which occur at
+        least min_count times.
+        '''
+        hot_keys = {}
+        for key in self.heavy_hitters.candidates():
+            count = self.count_min.estimate(key)
+            if count >= min_count:
+                hot_keys[key] = count
+        return hot_keys
+
+def test():
+    import random
+    random.seed(0)
+    keys = ['the'] * 3000 + ['null'] * 1000 + ['key_%d' % random.randint(0, 5000) for i in range(6000)]
+    random.shuffle(keys)
+
+    sketches = []
+    for i in range(4):
+        sketch = KeySketch()
+        sketch.update(keys[i::4])
+        sketches.append(sketch)
+    for sketch in sketches[1:]:
+        sketches[0].merge(sketch)
+
+    print 'total: %d, expected: 10000' % sketches[0].total
+    print 'hot keys: %s, expected: the >= 3000, null >= 1000' % sorted(sketches[0].hot_keys(500).items())
+
+if __name__ == '__main__':
+    test()
@@ -1,16 +1,64 @@
+import os
+import sys
 import heapq
-import json
+import operator
+import collections
+import itertools
+
+from codec import get_codec
 
 DEFAULT_MAX_RESULTS_NUM = 10000
+DEFAULT_MERGE_FACTOR = 10
 
 HEAP_NORMAL = 0
 HEAP_FULL = 1
+BUDGET_FULL = 2
+
+# the k/v tuple and its slot in a list
+RECORD_OVERHEAD = sys.getsizeof((None, None)) + 8
+
+def record_size(key, value):
+    '''
+    Returns the approximate bytes of a k/v pair held in memory. The
+    items of the containers, e.g. of a list value, are not counted.
+    '''
+    return RECORD_OVERHEAD + sys.getsizeof(key) + sys.getsizeof(value)
+
+class MemoryBudget(object):
+    '''
+    The MemoryBudget adds up the approximate bytes of the k/v pairs
+    buffered by a task, e.g. in the slices of a HeapSorter and in the
+    combine buffer of a collector, against a limit of bytes, so that
+    the buffers are spilled by their size instead of by a fixed number
+    of pairs.
+    '''
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+
+    def acquire(self, size):
+        self.used += size
+
+    def release(self, size):
+        self.used -= size
+
+    def exceeded(self):
+        return self.used >= self.limit
 
 class HeapSorter(object):
-    def __init__(self, slice_num):
+    '''
+    The HeapSorter keeps the k/v pairs of each slice in a list until
+    they are taken by get_all_results(), which sorts them at once. If a MemoryBudget is given,
+    the bytes of the pairs are added to it, and add() returns
+    BUDGET_FULL once it is exceeded, then the largest slice, see
+    largest_slice(), should be spilled.
+    '''
+    def __init__(self, slice_num, budget=None):
         self.slice_num = slice_num
         self.max_results_num = DEFAULT_MAX_RESULTS_NUM
         self.local_results = [[] for i in range(slice_num)]
+        self.budget = budget
+        self.local_bytes = [0] * slice_num
 
     def set_max_result_num(self, max_res_num):
         '''
@@ -18,39 +66,226 @@ class HeapSorter(object):
         stored in the local_results. Since large number of
         k/v pairs consumes large amount of memory, no element
         should be added in case that the number of existing
-        k/v pairs achieves the max_results_num.
+        k/v pairs achieves the max_results_num. It may be raised
+        when the memory is bounded by a MemoryBudget instead.
         '''
-        if max_res_num < self.max_results_num:
-            self.max_results_num = max_res_num
+        self.max_results_num = max_res_num
 
-    def add(self, index, k, v):
-        heapq.heappush(self.local_results[index], (k, v))
+    def _state(self, index, size):
+        if self.budget is not None:
+            self.local_bytes[index] += size
+            self.budget.acquire(size)
         if len(self.local_results[index]) >= self.max_results_num:
             return HEAP_FULL
+        if self.budget is not None and self.budget.exceeded():
+            return BUDGET_FULL
         return HEAP_NORMAL
 
+    def add(self, index, k, v):
+        self.local_results[index].append((k, v))
+        return self._state(index, record_size(k, v) if self.budget is not None else 0)
+
+    def add_batch(self, index, kvs):
+        '''
+        Adds a list of k/v pairs at once.
+        '''
+        self.local_results[index].extend(kvs)
+        size = sum(record_size(k, v) for k, v in kvs) if self.budget is not None else 0
+        return self._state(index, size)
+
+    def largest_slice(self):
+        '''
+        Returns the index of the slice holding the most bytes.
+        '''
+        return max(xrange(self.slice_num), key=self.local_bytes.__getitem__)
+
     def get_all_results(self, index):
-        for i in xrange(len(self.local_results[index])):
-            yield heapq.heappop(self.local_results[index])
+        if self.budget is not None:
+            self.budget.release(self.local_bytes[index])
+            self.local_bytes[index] = 0
+        results, self.local_results[index] = self.local_results[index], []
+        results.sort()
+        return iter(results)
+
+def merge_sorted(iterables):
+    '''
+    Merges the sorted k/v iterables into one sorted k/v iterator. Only the
+    keys are compared: the k/v pairs with the same key are yielded in the
+    order of the iterables.
+    '''
+    heap = []
+    for idx, iterable in enumerate(iterables):
+        iterator = iter(iterable)
+        for k, v in iterator:
+            heap.append((k, idx, v, iterator))
+            break
+    heapq.heapify(heap)
+
+    while heap:
+        k, idx, v, iterator = heap[0]
+        yield k, v
+        for k, v in iterator:
+            heapq.heapreplace(heap, (k, idx, v, iterator))
+            break
+        else:
+            heapq.heappop(heap)
+
+# marks that no value is peeked by ValuesIterator.__nonzero__()
+_NO_VALUE = object()
+
+class ValuesIterator(object):
+    '''
+    The ValuesIterator iterates the values of one key once, they are
+    streamed from the sorted inputs, so only the current value is in
+    memory no matter how many values the key has.
+
+    For the reducers written against a list of values, the first
+    len(values) loads the values not iterated yet into a list, which is
+    iterated by each iteration afterwards, so the values can be iterated
+    again once len() is called. len() counts the values iterated before
+    it is called too, e.g. sum(values) / len(values) is the mean, but
+    those values are not iterated again.
+    '''
+    __slots__ = ('values', 'loaded', 'consumed', 'peeked', 'size')
+
+    def __init__(self, values):
+        self.values = iter(values)
+        self.loaded = None
+        self.consumed = 0
+        self.peeked = _NO_VALUE
+        self.size = None
+
+    def __iter__(self):
+        if self.loaded is not None:
+            return iter(self.loaded)
+        return self
+
+    def next(self):
+        if self.peeked is not _NO_VALUE:
+            value, self.peeked = self.peeked, _NO_VALUE
+        else:
+            value = next(self.values)
+        self.consumed += 1
+        return value
+
+    def __len__(self):
+        if self.loaded is None:
+            self.loaded = [] if self.peeked is _NO_VALUE else [self.peeked]
+            self.loaded.extend(self.values)
+            self.values = iter(self.loaded)
+            self.peeked = _NO_VALUE
+            self.size = self.consumed + len(self.loaded)
+        return self.size
+
+    def __nonzero__(self):
+        if self.loaded is not None:
+            return bool(self.loaded)
+        if self.peeked is not _NO_VALUE:
+            return True
+        for value in self.values:
+            self.peeked = value
+            return True
+        return False
+
+def write_run(path, kvs, codec):
+    count = 0
+    writer = codec.writer(open(path, 'wb'))
+    try:
+        for k, v in kvs:
+            writer.write(k, v)
+            count += 1
+    finally:
+        writer.close()
+    return count
 
 class ConcurrentMergeSorter(object):
     '''
     The ConcurrentMergeSorter merges all the lists at the
     same time. Each time the smallest element of all the
     first elements of each list is moved to a final list.
-    This kind of sorter is useful if the number of elements
-    is small.
+    This kind of sorter is useful if the number of lists
+    is small, since only the first element of each list is
+    kept in memory.
+
+    The lists are sorted k/v iterables, e.g. the sorted map
+    outputs of one partition, which are read lazily.
     '''
-    pass
+    def __init__(self, iterables):
+        self.iterables = iterables
+
+    def get_all_results(self):
+        return merge_sorted(self.iterables)
+
+    def get_all_groups(self):
+        '''
+        Yields (key, values) for each key in order, the values is a
+        ValuesIterator over the values of the key, which must be consumed
+        before the next group is taken.
+        '''
+        get_value = operator.itemgetter(1)
+        for key, kvs in itertools.groupby(self.get_all_results(), operator.itemgetter(0)):
+            yield key, ValuesIterator(itertools.imap(get_value, kvs))
 
 class SequentMergeSorter(object):
     '''
-    The SequentMergeSorter each time generates a merged list from two
-    sorted lists by merge sorting. As a result, the number 
-    of lists left to be merged is reduced by one each time, 
+    The SequentMergeSorter each time generates a merged list from
+    merge_factor sorted lists by merge sorting. As a result, the number
+    of lists left to be merged is reduced by merge_factor - 1 each time,
     util there is only one list containing all the elements
     of original lists is left. If there is a large number
     of elements need to be merged, this kind of sorter should
     be used.
+
+    The sorted lists are spilled to files under spill_path, so the
+    number of elements is not limited by memory: only the merge_factor
+    lists being merged are read at the same time.
     '''
-    pass
+    def __init__(self, spill_path, prefix, merge_factor=DEFAULT_MERGE_FACTOR, codec=None):
+        if merge_factor < 2:
+            raise ValueError('merge_factor must be at least 2, got %s' % str(merge_factor))
+        self.spill_path = spill_path
+        self.prefix = prefix
+        self.merge_factor = merge_factor
+        self.codec = get_codec(codec)
+        self.runs = [] # (number of k/v pairs, spill file path)
+        self.spill_count = 0
+
+    def _next_path(self):
+        path = os.path.join(self.spill_path, '%s.spill_%d' % (self.prefix, self.spill_count))
+        self.spill_count += 1
+        return path
+
+    def spill(self, sorted_kvs):
+        '''
+        Spills a sorted k/v iterable to a new file.
+        '''
+        path = self._next_path()
+        self.runs.append((write_run(path, sorted_kvs, self.codec), path))
+
+    def add_run(self, path):
+        '''
+        Adds a sorted file written with the codec as a run, which is
+        removed once it is merged like the spilled files. The size of
+        the file stands for its number of k/v pairs.
+        '''
+        self.runs.append((os.path.getsize(path), path))
+
+    def get_all_results(self):
+        '''
+        Yields all the spilled k/v pairs in order, and removes the spill files.
+        '''
+        # merge the smallest lists first, until the rest can be merged at once
+        while len(self.runs) > self.merge_factor:
+            self.runs.sort()
+            merging, self.runs = self.runs[:self.merge_factor], self.runs[self.merge_factor:]
+            self.spill(merge_sorted([self.codec.read_file(path) for count, path in merging]))
+            for count, path in merging:
+                os.remove(path)
+
+        merging, self.runs = self.runs, []
+        try:
+            for k, v in merge_sorted([self.codec.read_file(path) for count, path in merging]):
+                yield k, v
+        finally:
+            for count, path in merging:
+                os.remove(path)
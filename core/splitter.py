@@ -1,17 +1,43 @@
 import os
 import sys
+import mmap
+import heapq
+import hashlib
 import logging
-import json
+
+from codec import get_codec
+from compressed import GZIP, detect_format, is_bgzf, bgzf_blocks, open_input, read_range as read_compressed_range
+
+# the ranges of the RangeSplitter are at least 64KB, unless the file is smaller
+MIN_RANGE_SIZE = 64 * 1024
 
 class BaseSplitter(object):
     '''
     A splitter partitions the input data into even parts which are distributed among multiple mappers.
     Note that the BaseSplitter cannot be initialized, since the _split() method is not implemented.
+    The gzip, bz2 and xz inputs are detected by their extensions or magic bytes and decompressed on
+    the fly, see compressed.py.
     '''
     def __init__(self, input, splitter_outputers, slice_num):
         self.input = input
         self.outputers = splitter_outputers
         self.slice_num = slice_num
+        self.codec = get_codec(None)
+        self.partitions = [(0, idx) for idx in range(slice_num)]
+
+    def set_codec(self, codec):
+        '''
+        The codec serializes the k/v pairs written to the outputers, see codec.py.
+        '''
+        self.codec = get_codec(codec)
+
+    def set_partitions(self, partitions):
+        '''
+        The partitions is a heap of the (bytes, index) of the data partitions, the splitters of
+        several input dirs share it so that their ranges are assigned as a whole, see
+        RangeSplitter._assign_ranges().
+        '''
+        self.partitions = partitions
 
     def _check_env(self):
         if self.input is None:
@@ -21,7 +47,7 @@ class BaseSplitter(object):
             logging.error("The input path %s is not exist" % str(self.input))
             return False
 
-        if type(self.outputers) is list or len(self.outputers) != self.slice_num:
+        if type(self.outputers) is not list or len(self.outputers) != self.slice_num:
             logging.error("The splitter outputer is invalide with type=%s, length[%d] != %d." % \
                     (str(type(self.outputers)), 
                      0 if type(self.outputers) is not list else len(self.outputers), 
@@ -30,20 +56,65 @@ class BaseSplitter(object):
 
         return True
 
-    def _format_kv(self, k, v):
-        return '%s\n' % json.dumps({k, v})
+    def _write_kv(self, idx, k, v):
+        self.writers[idx].write(k, v)
+
+    @classmethod
+    def read_split(cls, split_path, codec=None):
+        '''
+        Reads back the k/v pairs of one data partition written by _split(),
+        it is called by the mapper process which consumes the partition.
+        '''
+        return get_codec(codec).read_file(split_path)
+
+    @classmethod
+    def split_size(cls, split_path, codec=None):
+        '''
+        Returns the number of bytes of the input data in one data partition,
+        which is used to estimate the progress of the mapper.
+        '''
+        return os.path.getsize(split_path)
+
+    @classmethod
+    def split_ranges(cls, split_path, codec=None):
+        '''
+        Returns the (file, range) of the input files read by one data partition, or None if the
+        partition holds the input data itself. The outputs of each range are cached apart, so they
+        are reused however the ranges are packed into the partitions, see cache.py.
+        '''
+        return None
+
+    @classmethod
+    def split_fingerprint(cls, split_path, codec=None):
+        '''
+        Returns the sha1 hex digest of the input data of one data partition,
+        by which the outputs of the partition are cached, see cache.py.
+        '''
+        digest = hashlib.sha1()
+        with open(split_path, 'rb') as split:
+            for chunk in iter(lambda: split.read(1 << 20), ''):
+                digest.update(chunk)
+        return digest.hexdigest()
 
     def _get_inputs(self):
         if os.path.isdir(self.input):
             for file in os.listdir(self.input):
-               yield os.path.join(self.input, file)
+                # skip the hidden files and the meta files of a job, e.g. _report.json
+                if file.startswith('_') or file.startswith('.'):
+                    continue
+                yield os.path.join(self.input, file)
         else:
             yield self.input
 
     def split(self):
         if not self._check_env():
             return False
-        return self._split()
+        self.writers = [self.codec.writer(outputer) for outputer in self.outputers]
+        result = self._split()
+        # the outputers are closed by their owner
+        for writer in self.writers:
+            writer.flush()
+        return result
 
 class LineSplitter(BaseSplitter):
     '''
@@ -55,15 +126,165 @@ class LineSplitter(BaseSplitter):
         idx = 0
         for file in self._get_inputs():
             logging.info("The LineSplitter is splitting file: %s" % str(file))
-            for line in open(file):
+            for line in open_input(file):
                 if idx >= self.slice_num: # do not use operator % which is computationally cost
                     idx = 0
-                self.outputers[idx].write(self._format_kv(str(line_count), line[:-1]))
+                self._write_kv(idx, str(line_count), line[:-1])
                 line_count += 1
                 idx += 1
         logging.info("The LineSplitter stops, there are %d lines." % line_count)
         return True
 
+class RangeSplitter(BaseSplitter):
+    '''
+    RangeSplitter does not copy any input data. It cuts each input file into newline-aligned
+    byte ranges, i.e. (file, offset, length) like the FileSplit of hadoop, and assigns the ranges
+    to the data partitions so that each partition has about the same number of bytes. Only the
+    descriptions of the ranges are written to the outputers, and each mapper reads its own ranges
+    directly from the input files through mmap.
+    The byte offset of each line is the key, while the line is the value.
+    A BGZF file is cut into ranges of whole blocks, which are decompressed by the mappers in parallel,
+    the key of a line is then its BGZF virtual offset. The other compressed files can not be cut, each
+    of them is one range, and the key of a line is its offset in the decompressed data.
+    '''
+    min_range_size = MIN_RANGE_SIZE
+
+    def _get_bgzf_ranges(self, file, range_size):
+        '''
+        Groups the BGZF blocks into ranges of about range_size bytes, each
+        range also holds the offset of the block before it.
+        '''
+        ranges = []
+        start = length = 0
+        prev_offset = None
+        last_offset = None
+        for offset, size in bgzf_blocks(file):
+            if length >= range_size:
+                ranges.append((file, start, length, prev_offset))
+                start, length, prev_offset = offset, 0, last_offset
+            length += size
+            last_offset = offset
+        if length > 0:
+            ranges.append((file, start, length, prev_offset))
+        return ranges
+
+    def _get_ranges(self, file, range_size):
+        file_size = os.path.getsize(file)
+        fmt = detect_format(file)
+        if fmt == GZIP and is_bgzf(file):
+            return self._get_bgzf_ranges(file, range_size)
+        if fmt is not None:
+            # the other compressed files can only be read from the start
+            return [(file, 0, file_size)]
+        ranges = []
+        with open(file, 'rb') as reader:
+            offset = 0
+            while offset < file_size:
+                end = offset + range_size
+                if end < file_size:
+                    # move the end to the first line break at or after it
+                    reader.seek(end - 1)
+                    reader.readline()
+                    end = reader.tell()
+                end = min(end, file_size)
+                ranges.append((file, offset, end - offset))
+                offset = end
+        return ranges
+
+    def _split(self):
+        files = list(self._get_inputs())
+        total_size = sum(os.path.getsize(file) for file in files)
+        # the range size is rounded down to a power of 2 times the min range size, so that the ranges,
+        # by which the map outputs are cached, are kept when some files are added
+        range_size = self.min_range_size
+        while range_size * 2 <= total_size / self.slice_num:
+            range_size *= 2
+
+        ranges = []
+        for file in files:
+            logging.info("The RangeSplitter is splitting file: %s" % str(file))
+            ranges.extend(self._get_ranges(file, range_size))
+
+        self._assign_ranges(ranges)
+        logging.info("The RangeSplitter stops, there are %d ranges of %d bytes." % (len(ranges), total_size))
+        return True
+
+    def _assign_ranges(self, ranges):
+        '''
+        Assigns the ranges to the partitions by the longest processing time
+        first rule: the longest range goes to the partition with the fewest
+        bytes, so that the partitions have about the same number of bytes.
+        The bytes assigned by the splitters of the former input dirs are
+        counted as well, see set_partitions().
+        '''
+        for r in sorted(ranges, key=lambda r: r[2], reverse=True):
+            size, idx = heapq.heappop(self.partitions)
+            self._write_kv(idx, r[0], list(r[1:]))
+            heapq.heappush(self.partitions, (size + r[2], idx))
+
+    @classmethod
+    def read_range(cls, file, offset, length, prev_offset=None):
+        '''
+        Yields the (offset, line) of each line in the range through mmap,
+        or by decompressing it if the file is compressed.
+        '''
+        if length <= 0:
+            return
+        if detect_format(file) is not None:
+            for kv in read_compressed_range(file, offset, length, prev_offset):
+                yield kv
+            return
+        with open(file, 'rb') as reader:
+            # the offset of mmap must be a multiple of the allocation granularity
+            start = offset - offset % mmap.ALLOCATIONGRANULARITY
+            buf = mmap.mmap(reader.fileno(), offset + length - start,
+                    access=mmap.ACCESS_READ, offset=start)
+            try:
+                pos = offset - start
+                end = pos + length
+                while pos < end:
+                    line_end = buf.find('\n', pos, end)
+                    if line_end < 0:
+                        line_end = end
+                    yield start + pos, buf[pos:line_end]
+                    pos = line_end + 1
+            finally:
+                buf.close()
+
+    @classmethod
+    def read_file_range(cls, file, file_range, codec=None):
+        return cls.read_range(file, *file_range)
+
+    @classmethod
+    def read_split(cls, split_path, codec=None):
+        for file, file_range in cls.split_ranges(split_path, codec):
+            for k, v in cls.read_file_range(file, file_range, codec):
+                yield k, v
+
+    @classmethod
+    def split_ranges(cls, split_path, codec=None):
+        return [(file, tuple(file_range)) for file, file_range in super(RangeSplitter, cls).read_split(split_path, codec)]
+
+    @classmethod
+    def split_size(cls, split_path, codec=None):
+        return sum(file_range[1] for file, file_range in cls.split_ranges(split_path, codec))
+
+    @classmethod
+    def range_fingerprint(cls, file, file_range):
+        '''
+        Returns the sha1 hex digest of a range of a file, the ranges are not copied, so the size and
+        mtime of their files tell the changes.
+        '''
+        stat = os.stat(file)
+        return hashlib.sha1(repr((os.path.abspath(file), tuple(file_range), stat.st_size, stat.st_mtime))).hexdigest()
+
+    @classmethod
+    def split_fingerprint(cls, split_path, codec=None):
+        digest = hashlib.sha1()
+        for file, file_range in cls.split_ranges(split_path, codec):
+            digest.update(cls.range_fingerprint(file, file_range))
+        return digest.hexdigest()
+
 class LineSeperatorSplitter(BaseSplitter):
     '''
     The LineSeperatorSplitter performs the same as the LineSplitter mostly, except that you can specify the 
@@ -102,7 +323,7 @@ class LineSeperatorSplitter(BaseSplitter):
         idx = 0
         for file in self._get_inputs():
             logging.info("The LineSplitter is splitting file: %s" % str(file))
-            for line in open(file):
+            for line in open_input(file):
                 parts = line[:-1].split(self.seperatoe)
                 if self.key_idx > len(parts) or self.value_idx > len(parts):
                     logging.warning("The length of line: %s is less than key/value:%d/%d index." % \
@@ -111,28 +332,84 @@ class LineSeperatorSplitter(BaseSplitter):
 
                 if idx >= self.slice_num: # do not use operator % which is computationally cost
                     idx = 0
-                self.outputers[idx].write(self._format_kv(parts[self.key_idx], parts[self.value_idx]))
+                self._write_kv(idx, parts[self.key_idx], parts[self.value_idx])
                 line_count += 1
                 idx += 1
         logging.info("The LineSplitter stops, there are %d lines." % line_count)
         return True
 
-class FileSplitter(BaseSplitter):
+class FileSplitter(RangeSplitter):
     '''
-    The FileSplitter just renames the file names of the input dir, without the breaking of each file.
     The input of the FileSplitter must be a directory.
+    Each file is a whole range of the RangeSplitter, so the many small files are packed into the
+    data partitions by their bytes, and each mapper reads its files directly. The byte offset of
+    each line is the key, while the line is the value.
     '''
     def _check_env(self):
-        if not BaseSplitter._check_env():
+        if not RangeSplitter._check_env(self):
             return False
 
         if not os.path.isdir(self.input):
+            logging.error("The input path %s of the FileSplitter is not a directory" % str(self.input))
             return False
 
         return True
 
     def _split(self):
-        pass
+        ranges = [(file, 0, os.path.getsize(file)) for file in self._get_inputs()]
+        self._assign_ranges(ranges)
+        logging.info("The FileSplitter stops, there are %d files of %d bytes." % \
+                (len(ranges), sum(r[2] for r in ranges)))
+        return True
+
+class KVFileSplitter(FileSplitter):
+    '''
+    The KVFileSplitter reads the k/v files written by a collector with the codec of the splitter, e.g.
+    the outputs of the reducers of another job, see pipeline.py. Like the FileSplitter, whole files are
+    packed into the data partitions by their bytes and only their names are written to the outputers,
+    then each mapper reads the k/v pairs of its files as they were collected, without parsing any line.
+    A large file with a block index, see BinaryCodec.read_index(), is cut into ranges of whole blocks
+    like the RangeSplitter does, so that a job may run more mappers than the reducers of its upstream job.
+    '''
+    def _get_ranges(self, file, range_size):
+        with open(file, 'rb') as stream:
+            index = self.codec.read_index(stream)
+        if not index:
+            return [(file, 0, os.path.getsize(file))]
+        ranges = []
+        start = length = 0
+        for offset, block_length, records_num in index:
+            if length >= range_size:
+                ranges.append((file, start, length))
+                start, length = offset, 0
+            length += block_length
+        ranges.append((file, start, length))
+        return ranges
+
+    def _split(self):
+        return RangeSplitter._split(self)
+
+    @classmethod
+    def read_range(cls, file, offset, length, codec=None):
+        '''
+        Yields the k/v pairs of the blocks in the range, or of the whole
+        file if the range is not made of the blocks of its index.
+        '''
+        kv_codec = get_codec(codec)
+        if offset == 0 and length == os.path.getsize(file):
+            for k, v in kv_codec.read_file(file):
+                yield k, v
+            return
+        with open(file, 'rb') as stream:
+            end = offset + length
+            while offset < end:
+                for k, v in kv_codec.read_block(stream, offset):
+                    yield k, v
+                offset = stream.tell()
+
+    @classmethod
+    def read_file_range(cls, file, file_range, codec=None):
+        return cls.read_range(file, *file_range, codec=codec)
 
 def test():
     test_data_path = './test/data'
@@ -143,5 +420,35 @@ def test():
 
     file_splitter = FileSplitter(test_data_path, test_output, 4)
 
+def test_kv_file_splitter():
+    import shutil
+    import tempfile
+    path = tempfile.mkdtemp()
+    try:
+        codec = get_codec('binary', block_records=100)
+        input_path = os.path.join(path, 'input')
+        os.makedirs(input_path)
+        kvs = [('key_%05d' % i, 'x' * (i % 100)) for i in range(20000)]
+        for idx in range(2):
+            writer = codec.writer(open(os.path.join(input_path, 'part_%d' % idx), 'wb'))
+            for k, v in kvs[idx::2]:
+                writer.write(k, v)
+            writer.close()
+
+        split_paths = [os.path.join(path, 'split_%d' % i) for i in range(8)]
+        outputers = [open(split_path, 'wb') for split_path in split_paths]
+        splitter = KVFileSplitter(input_path, outputers, 8)
+        splitter.set_codec(codec)
+        splitter.split()
+        for outputer in outputers:
+            outputer.close()
+        got = [kv for split_path in split_paths for kv in KVFileSplitter.read_split(split_path, codec)]
+        print 'ranges: %d, expected: > 2' % sum(len(list(BaseSplitter.read_split(split_path, codec))) \
+                for split_path in split_paths)
+        print 'k/v pairs: %s' % (sorted(got) == kvs)
+    finally:
+        shutil.rmtree(path)
+
 if __name__ == '__main__':
     test()
+    test_kv_file_splitter()
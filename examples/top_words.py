@@ -0,0 +1,54 @@
+import sys
+import heapq
+
+from core.job import Job, DefaultConfigure
+from core.pipeline import Pipeline
+from core.mapper import BaseMapper
+from core.reducer import BaseReducer
+from word_count import WordCountMapper, WordCountReducer
+
+TOP_N = 10
+
+class TopMapper(BaseMapper):
+    def map(self, key, value, collector):
+        collector.collect('top', (value, key))
+
+class TopReducer(BaseReducer):
+    def reduce(self, key, values, collector):
+        for count, word in heapq.nlargest(TOP_N, values):
+            collector.collect(word, count)
+
+class LengthMapper(BaseMapper):
+    def map(self, key, value, collector):
+        collector.collect(len(key), value)
+
+def new_job(mapper_class, reducer_class, output_path, reducer_num=1):
+    job = Job(DefaultConfigure())
+    job.set_mapper(mapper_class)
+    job.set_mapper_num(4)
+    job.set_reducer_class(reducer_class)
+    job.set_reducer_num(reducer_num)
+    job.set_output_path(output_path)
+    return job
+
+def main():
+    if len(sys.argv) < 3:
+        print 'usage: %s input_dir output_dir' % sys.argv[0]
+        return
+
+    # the counts of the words feed both the top words and the histogram of the word lengths,
+    # which run at the same time
+    word_count = new_job(WordCountMapper, WordCountReducer, sys.argv[2] + '/word_count', 4)
+    word_count.set_combiner_class(WordCountReducer)
+    word_count.add_input_dir(sys.argv[1])
+
+    pipeline = Pipeline()
+    pipeline.add_job('word_count', word_count)
+    pipeline.add_job('top_words', new_job(TopMapper, TopReducer, sys.argv[2] + '/top_words'), ['word_count'])
+    pipeline.add_job('word_lengths', new_job(LengthMapper, WordCountReducer, sys.argv[2] + '/word_lengths'),
+            ['word_count'])
+
+    print pipeline.run()
+
+if __name__ == '__main__':
+    main()
@@ -9,11 +9,11 @@ class WordCountMapper(BaseMapper):
     def map(self, key, value, collector):
         words = value.split()
         for word in words:
-            collecter.collect(word, 1)
+            collector.collect(word, 1)
 
 class WordCountReducer(BaseReducer):
     def reduce(self, key, values, collector):
-        count = len(values)
+        count = sum(values)
         collector.collect(key, count)
 
 def main():
@@ -23,13 +23,14 @@ def main():
         
     conf = DefaultConfigure()
     job = Job(conf)
-    job.set_splliter(LineSplitter)
+    job.set_splitter(LineSplitter)
     job.set_mapper(WordCountMapper)
     job.set_mapper_num(4)
-    job.set_reducer(WordCountReducer)
+    job.set_reducer_class(WordCountReducer)
+    job.set_combiner_class(WordCountReducer)
     job.set_reducer_num(1)
     
-    job.add_input_path(sys.argv[1])
+    job.add_input_dir(sys.argv[1])
     job.set_output_path(sys.argv[2])
     
     print job.run()